@@ -0,0 +1,288 @@
+"""Benchmark spreading shortcut runs over worker agents.
+
+Starts the OSUI server in-process on a scratch database with local shortcut
+execution turned off, then starts agent processes (`webui.py agent`) on this
+machine as stand-ins for separate Macs, each with benchmarks/fake_cli.py as its
+Shortcuts CLI. A synthetic wide workflow (one branch step fanning out to
+--wide branches, then a merge) is run from concurrent clients for each agent
+count, and the throughput, latency and jobs run per agent are reported.
+
+    python benchmarks/agents.py --agents 1,2,4 --slots 2 --runs 20 --latency 0.2
+
+With --check it instead starts two single-slot agents and checks that
+concurrent jobs are spread over both, that cancelling a run kills its job on
+the agent, and that a job on an agent that is killed is placed on the other
+one. It exits non-zero if any of these fails.
+
+    python benchmarks/agents.py --check
+"""
+import argparse
+import collections
+import http.client
+import json
+import os
+import shlex
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Read when webui is imported: the server must hand every shortcut to an agent
+os.environ['OSUI_LOCAL_SHORTCUTS'] = '0'
+# The check waits for a killed agent to time out, so it uses a short timeout
+os.environ.setdefault('OSUI_AGENT_TIMEOUT', '4' if '--check' in sys.argv else '10')
+
+import webui  # noqa: E402
+
+FAKE_CLI = shlex.quote(os.path.join(REPO_ROOT, 'benchmarks', 'fake_cli.py'))
+MODEL = 'llama3.1:latest'
+CHECK_LATENCY = 4
+
+
+class QuietHandler(webui.OllamaHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def wide_workflow(branches):
+    return {'id': 'bench-wide', 'name': f'Wide ({branches} branches)', 'steps': [
+        {'id': 'fan-out', 'name': 'Fan out', 'type': 'branch', 'branches': [
+            [{'id': f'branch-{i}', 'name': f'Branch {i}', 'type': 'normal', 'shortcutName': f'Benchmark Shortcut {i % 4}',
+              'model': MODEL, 'systemPrompt': 'Analyse the input.'}]
+            for i in range(branches)]},
+        {'id': 'merge', 'name': 'Merge', 'type': 'merge', 'branchStepIndex': 0,
+         'shortcutName': 'Benchmark Shortcut 4', 'model': MODEL, 'systemPrompt': 'Combine the branch outputs.'},
+    ]}
+
+
+def single_workflow():
+    return {'id': 'bench-single', 'name': 'Single shortcut', 'steps': [
+        {'id': 'only', 'name': 'Only', 'type': 'normal', 'shortcutName': 'Benchmark Shortcut 0',
+         'model': MODEL, 'systemPrompt': 'Analyse the input.'}]}
+
+
+def start_agents(port, count, slots, latency):
+    env = dict(os.environ,
+               OSUI_AGENT_SERVER=f'http://127.0.0.1:{port}',
+               OSUI_AGENT_SLOTS=str(slots),
+               OSUI_SHORTCUTS_BIN=f"{shlex.quote(sys.executable)} {FAKE_CLI} shortcuts",
+               OSUI_OLLAMA_BIN=f"{shlex.quote(sys.executable)} {FAKE_CLI} ollama",
+               OSUI_LOG_LEVEL='WARNING',
+               FAKE_LATENCY=str(latency))
+    agents = [subprocess.Popen([sys.executable, os.path.join(REPO_ROOT, 'webui.py'), 'agent'],
+                               env=dict(env, OSUI_AGENT_NAME=f'agent-{i}'))
+              for i in range(count)]
+    deadline = time.time() + 30
+    while sum(agent['live'] for agent in webui.list_agents()) < count:
+        if time.time() > deadline:
+            raise RuntimeError('agents did not register')
+        time.sleep(0.1)
+    return agents
+
+
+def run_body(workflow_id):
+    return json.dumps({'workflow_id': workflow_id, 'input': {'user_input': 'Benchmark input. ' * 20, 'model': MODEL}})
+
+
+def run_client(port, runs, timings, run_ids, errors):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    body = run_body('bench-wide')
+    for _ in range(runs):
+        start = time.perf_counter()
+        conn.request('POST', '/api/run-workflow', body, {'Content-Type': 'application/json'})
+        result = json.loads(conn.getresponse().read())
+        if result.get('status') == 'completed':
+            timings.append((time.perf_counter() - start) * 1000)
+            run_ids.append(result['run_id'])
+        else:
+            errors.append(result.get('message'))
+    conn.close()
+
+
+def jobs_per_agent(run_ids):
+    counts = collections.Counter()
+    for run_id in run_ids:
+        for event in webui.chrome_trace(webui.get_run(run_id))['traceEvents']:
+            if event.get('cat') == 'agent':
+                counts[event['args']['agent']] += 1
+    return dict(sorted(counts.items()))
+
+
+def agent_spans(run_id):
+    return [(event['args']['agent'], event['args'].get('status'), event['args'].get('error'))
+            for event in webui.chrome_trace(webui.get_run(run_id))['traceEvents'] if event.get('cat') == 'agent']
+
+
+def start_run(port, workflow_id):
+    # Runs a workflow on a thread; the response lands in the returned dict
+    result = {}
+
+    def run():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        conn.request('POST', '/api/run-workflow', run_body(workflow_id), {'Content-Type': 'application/json'})
+        result.update(json.loads(conn.getresponse().read()))
+        conn.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, result
+
+
+def query(sql, params=()):
+    conn = sqlite3.connect('ollama_workflows.db')
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return rows
+
+
+def wait_for(condition, timeout, what):
+    deadline = time.time() + timeout
+    while True:
+        value = condition()
+        if value:
+            return value
+        if time.time() > deadline:
+            raise AssertionError(f"timed out waiting for {what}")
+        time.sleep(0.05)
+
+
+def running_job():
+    # (job id, agent name) of the one running agent job
+    rows = query("SELECT j.id, a.name FROM agent_jobs j JOIN agents a ON a.id = j.agent_id WHERE j.status = 'running'")
+    return rows[0] if len(rows) == 1 else None
+
+
+def check(port):
+    agents = start_agents(port, 2, 1, CHECK_LATENCY)
+    try:
+        # Two branches at once go to different single-slot agents
+        thread, result = start_run(port, 'bench-wide')
+        thread.join()
+        assert result.get('status') == 'completed', result
+        counts = jobs_per_agent([result['run_id']])
+        assert sorted(counts) == ['agent-0', 'agent-1'], counts
+        print(f"ok  placement: jobs per agent {counts}")
+
+        # Cancelling the run kills the job on the agent, which then reports it
+        thread, result = start_run(port, 'bench-single')
+        job_id, agent_name = wait_for(running_job, 10, 'a running job')
+        run_id = wait_for(lambda: query("SELECT id FROM workflow_runs WHERE status = 'running'"), 5, 'the run')[0][0]
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.request('POST', f'/runs/{run_id}/cancel', '{}', {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        assert response.status == 200, response.status
+        cancelled_at = time.time()
+        thread.join()
+        assert result.get('status') != 'completed', result
+        wait_for(lambda: not query("SELECT 1 FROM agent_jobs WHERE id = ?", (job_id,)), CHECK_LATENCY, 'the job to be killed')
+        print(f"ok  cancel: job on {agent_name} killed {time.time() - cancelled_at:.1f}s after cancelling")
+
+        # A job whose agent dies is placed on the other agent
+        thread, result = start_run(port, 'bench-single')
+        job_id, agent_name = wait_for(running_job, 10, 'a running job')
+        agents[int(agent_name.split('-')[1])].kill()
+        thread.join()
+        assert result.get('status') == 'completed', result
+        spans = agent_spans(result['run_id'])
+        assert len(spans) == 2 and spans[0][0] == agent_name and spans[0][2] == 'agent lost' \
+            and spans[1][0] != agent_name, spans
+        print(f"ok  lost agent: job on {agent_name} placed again on {spans[1][0]}")
+    finally:
+        for agent in agents:
+            agent.terminate()
+        for agent in agents:
+            agent.wait()
+        forget_agents()
+
+
+def forget_agents():
+    conn = sqlite3.connect('ollama_workflows.db')
+    conn.execute("DELETE FROM agent_jobs")
+    conn.execute("DELETE FROM agents")
+    conn.commit()
+    conn.close()
+
+
+def bench(port, agent_count, args):
+    agents = start_agents(port, agent_count, args.slots, args.latency)
+    try:
+        timings, run_ids, errors = [], [], []
+        per_client = [args.runs // args.concurrency + (1 if i < args.runs % args.concurrency else 0)
+                      for i in range(args.concurrency)]
+        clients = [threading.Thread(target=run_client, args=(port, n, timings, run_ids, errors))
+                   for n in per_client if n]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        wall = time.perf_counter() - start
+    finally:
+        for agent in agents:
+            agent.terminate()
+        for agent in agents:
+            agent.wait()
+        # The next agent count starts from an empty registry
+        forget_agents()
+    timings.sort()
+    return {'agents': agent_count, 'runs': len(timings), 'errors': len(errors), 'wall_seconds': round(wall, 3),
+            'throughput_rps': round(len(timings) / wall, 3),
+            'p50_ms': round(statistics.median(timings), 1) if timings else None,
+            'max_ms': round(timings[-1], 1) if timings else None,
+            'jobs_per_agent': jobs_per_agent(run_ids)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--agents', default='1,2,4', help='comma-separated agent counts to run')
+    parser.add_argument('--slots', type=int, default=2, help='concurrent shortcut runs per agent')
+    parser.add_argument('--runs', type=int, default=20, help='workflow runs per agent count')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--wide', type=int, default=8, help='branches in the workflow')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds each fake shortcut run takes')
+    parser.add_argument('--check', action='store_true',
+                        help='check placement, cancellation and lost agents instead of benchmarking')
+    args = parser.parse_args()
+    webui.logging.disable(webui.logging.CRITICAL)
+
+    if not args.check:
+        print(f"{args.runs} runs of a {args.wide}-branch workflow, {args.concurrency} clients, "
+              f"{args.slots} slots per agent, {args.latency * 1000:.0f} ms per shortcut run")
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        webui.init_db()
+        webui.save_workflow(wide_workflow(2 if args.check else args.wide))
+        webui.save_workflow(single_workflow())
+        httpd = webui.ThreadingHTTPServer(('127.0.0.1', 0), QuietHandler)
+        # Long polls of stopped agents end in broken pipes
+        httpd.handle_error = lambda request, client_address: None
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        port = httpd.server_address[1]
+
+        if args.check:
+            check(port)
+        else:
+            for count in (int(value) for value in args.agents.split(',')):
+                result = bench(port, count, args)
+                line = (f"{count:2d} agents  {result['throughput_rps']:7.2f} runs/s  p50 {result['p50_ms']:8.1f} ms  "
+                        f"max {result['max_ms']:8.1f} ms  jobs per agent {result['jobs_per_agent']}")
+                if result['errors']:
+                    line += f"  ({result['errors']} errors)"
+                print(line)
+
+        httpd.shutdown()
+        # Open long polls notice their agent is gone within a second
+        time.sleep(1.5)
+        os.chdir(REPO_ROOT)
+
+
+if __name__ == '__main__':
+    main()
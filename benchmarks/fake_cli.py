@@ -0,0 +1,54 @@
+"""Stand-in for the `shortcuts` and `ollama` CLIs, for benchmarking without macOS.
+
+    python benchmarks/fake_cli.py shortcuts list
+    python benchmarks/fake_cli.py shortcuts run <name> --input-path <file>
+    python benchmarks/fake_cli.py ollama list
+
+Point the server at it with OSUI_SHORTCUTS_BIN / OSUI_OLLAMA_BIN. `shortcuts run`
+sleeps for FAKE_LATENCY seconds (plus up to FAKE_JITTER seconds of uniform
+jitter) and writes FAKE_OUTPUT_BYTES bytes of text that starts with the
+shortcut name and the input size. `shortcuts list` prints FAKE_SHORTCUTS names.
+"""
+import os
+import random
+import sys
+import time
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def shortcuts(args):
+    if args[:1] == ['list']:
+        for i in range(int(env_float('FAKE_SHORTCUTS', 20))):
+            print(f"Benchmark Shortcut {i}")
+        return 0
+    if len(args) == 4 and args[0] == 'run' and args[2] == '--input-path':
+        with open(args[3], 'rb') as f:
+            input_size = len(f.read())
+        time.sleep(env_float('FAKE_LATENCY', 0.05) + random.uniform(0, env_float('FAKE_JITTER', 0)))
+        header = f"{args[1]} received {input_size} bytes. "
+        size = int(env_float('FAKE_OUTPUT_BYTES', 512))
+        sys.stdout.write((header + "lorem ipsum " * (size // 12 + 1))[:max(size, len(header))])
+        return 0
+    print(f"unsupported arguments: {args}", file=sys.stderr)
+    return 2
+
+
+def ollama(args):
+    if args[:1] == ['list']:
+        print("NAME                ID              SIZE      MODIFIED")
+        print("llama3.1:latest     42182419e950    4.7 GB    2 days ago")
+        print("gemma2:latest       ff02c3702f32    5.4 GB    2 days ago")
+        return 0
+    print(f"unsupported arguments: {args}", file=sys.stderr)
+    return 2
+
+
+if __name__ == '__main__':
+    commands = {'shortcuts': shortcuts, 'ollama': ollama}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(__doc__, file=sys.stderr)
+        sys.exit(2)
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))
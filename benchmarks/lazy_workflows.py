@@ -0,0 +1,73 @@
+"""Benchmark loading a large workflow library with lazy JSON decoding.
+
+Seeds a scratch database with copies of the bundled workflows, then measures
+time and peak memory for get_workflows() when only id and name are read and
+when every workflow's steps are read, against an eager loader that decodes
+every JSON column up front. get_workflows(with_steps=False), which
+/api/workflows uses, reads the summary columns only.
+
+    python benchmarks/lazy_workflows.py --workflows 5000
+"""
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import webui  # noqa: E402
+
+
+def eager_get_workflows():
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    workflows = [record.to_dict() for record in webui.load_workflows(c)]
+    conn.close()
+    return workflows
+
+
+def measure(label, load, touch):
+    tracemalloc.start()
+    start = time.perf_counter()
+    workflows = load()
+    for workflow in workflows:
+        touch(workflow)
+    elapsed = (time.perf_counter() - start) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<24} {elapsed:9.1f} ms   peak {peak / 1024 / 1024:7.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workflows', type=int, default=5000, help='number of workflows to seed')
+    args = parser.parse_args()
+
+    templates = [json.load(open(path))['workflow'] for path in glob.glob(os.path.join(REPO_ROOT, 'workflows', '*.json'))]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        webui.init_db()
+        for i in range(args.workflows):
+            workflow = dict(templates[i % len(templates)], id=f"wf-{i}", name=f"Workflow {i}")
+            webui.save_workflow(workflow)
+        print(f"{args.workflows} workflows")
+
+        names_only = lambda w: (w['id'], w['name'])  # noqa: E731
+        steps = lambda w: len(w['steps'])  # noqa: E731
+        measure('eager, id and name', eager_get_workflows, names_only)
+        measure('lazy, id and name', webui.get_workflows, names_only)
+        measure('summary, id and name', lambda: webui.get_workflows(with_steps=False), names_only)
+        measure('eager, steps', eager_get_workflows, steps)
+        measure('lazy, steps', webui.get_workflows, steps)
+        os.chdir(REPO_ROOT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark the request fan-out the dashboard performs on every page load.
+
+Starts the OSUI server in-process against a scratch database seeded with the
+bundled workflows, then replays the page-load requests either on a fresh TCP
+connection per request (HTTP/1.0 behaviour) or on one persistent connection.
+
+    python benchmarks/page_load_fanout.py --loads 200
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import webui  # noqa: E402
+
+PAGE_LOAD_PATHS = ['/', '/shortcuts', '/workflows', '/knowledge-structures', '/user-prompts', '/ollama-models']
+
+
+class QuietHandler(webui.OllamaHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(workdir):
+    os.chdir(workdir)
+    webui.init_db()
+    for name in sorted(os.listdir(os.path.join(REPO_ROOT, 'workflows'))):
+        with open(os.path.join(REPO_ROOT, 'workflows', name)) as f:
+            webui.save_workflow(webui.parse_imported_workflow(json.load(f)))
+    for i in range(50):
+        webui.save_shortcut({'name': f'Shortcut {i}', 'description': 'User shortcut'})
+    httpd = webui.ThreadingHTTPServer(('127.0.0.1', 0), QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def page_load_new_connections(port):
+    for path in PAGE_LOAD_PATHS:
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', path, headers={'Connection': 'close'})
+        conn.getresponse().read()
+        conn.close()
+
+
+def page_load_keep_alive(conn):
+    for path in PAGE_LOAD_PATHS:
+        conn.request('GET', path)
+        conn.getresponse().read()
+
+
+def measure(label, loads, page_load):
+    timings = []
+    for _ in range(loads):
+        start = time.perf_counter()
+        page_load()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<28} median {statistics.median(timings):7.2f} ms   p95 {p95:7.2f} ms")
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--loads', type=int, default=100, help='page loads to replay per mode')
+    args = parser.parse_args()
+
+    # The ollama binary is usually absent here; keep its error logging out of the timings
+    webui.logging.disable(webui.logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        httpd = start_server(workdir)
+        port = httpd.server_address[1]
+        print(f"{len(PAGE_LOAD_PATHS)} requests per page load, {args.loads} loads per mode")
+
+        baseline = measure('connection per request', args.loads, lambda: page_load_new_connections(port))
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        keep_alive = measure('persistent connection', args.loads, lambda: page_load_keep_alive(conn))
+        conn.close()
+        print(f"speedup: {baseline / keep_alive:.2f}x")
+
+        httpd.shutdown()
+        os.chdir(REPO_ROOT)
+
+
+if __name__ == '__main__':
+    main()
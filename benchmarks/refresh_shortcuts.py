@@ -0,0 +1,76 @@
+"""Benchmark refresh_shortcuts against a large Shortcuts library.
+
+Compares the diffing, single-transaction refresh with the previous
+delete-everything-then-save_shortcut-per-row approach on a scratch database.
+
+    python benchmarks/refresh_shortcuts.py --shortcuts 2000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import webui  # noqa: E402
+
+
+def library(names):
+    return lambda: [{"id": str(uuid.uuid4()), "name": name, "description": "User shortcut"} for name in names]
+
+
+def legacy_refresh_shortcuts():
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute("DELETE FROM shortcuts")
+    conn.commit()
+    user_shortcuts = webui.get_user_shortcuts()
+    for shortcut in user_shortcuts:
+        webui.save_shortcut(shortcut)
+    conn.close()
+    return user_shortcuts
+
+
+def timed(refresh):
+    start = time.perf_counter()
+    refresh()
+    return (time.perf_counter() - start) * 1000
+
+
+def run_scenarios(label, refresh, count):
+    names = [f"Shortcut {i}" for i in range(count)]
+    changed = names[10:] + [f"New shortcut {i}" for i in range(10)]
+
+    conn = sqlite3.connect('ollama_workflows.db')
+    conn.execute("DELETE FROM shortcuts")
+    conn.commit()
+    conn.close()
+
+    webui.get_user_shortcuts = library(names)
+    initial = timed(refresh)
+    unchanged = timed(refresh)
+    webui.get_user_shortcuts = library(changed)
+    delta = timed(refresh)
+    print(f"{label:<10} initial {initial:9.1f} ms   unchanged {unchanged:9.1f} ms   10 added/10 removed {delta:9.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shortcuts', type=int, default=2000, help='size of the simulated library')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        webui.init_db()
+        print(f"{args.shortcuts} shortcuts")
+        run_scenarios('legacy', legacy_refresh_shortcuts, args.shortcuts)
+        run_scenarios('diffing', webui.refresh_shortcuts, args.shortcuts)
+        os.chdir(REPO_ROOT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark /search-style full-text queries over a large document set.
+
+Seeds a scratch database with knowledge structures, user prompts and workflows
+through the regular save functions' indexing path, then times ranked,
+snippeted, paginated queries. Finally it saves a workflow, drops the search
+index and times the rebuild init_db does at startup, checking that the
+workflow can be found again.
+
+    python benchmarks/search.py --documents 100000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import webui  # noqa: E402
+
+def make_vocabulary(size, rng):
+    # Pseudo-words drawn with Zipf weights, so term selectivity resembles prose:
+    # the top words appear in nearly every document, most words in very few
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = sorted({''.join(rng.choices(letters, k=rng.randint(3, 9))) for _ in range(size * 2)})[:size]
+    rng.shuffle(words)
+    return words, [1 / rank for rank in range(1, size + 1)]
+
+
+def seed(documents, vocabulary_size=20000):
+    rng = random.Random(0)
+    words, weights = make_vocabulary(vocabulary_size, rng)
+    kinds = ['knowledge_structure', 'user_prompt', 'workflow']
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    for i in range(documents):
+        title = ' '.join(rng.choices(words, weights, k=4))
+        body = ' '.join(rng.choices(words, weights, k=rng.randint(50, 400)))
+        webui.index_search_document(c, kinds[i % 3], f"doc-{i}", title, body)
+    conn.commit()
+    conn.close()
+    return words
+
+
+def rebuild():
+    webui.save_workflow({'id': 'rebuild-check', 'name': 'Rebuild check', 'steps': [
+        {'id': 'step-1', 'name': 'Step 1', 'type': 'normal', 'systemPrompt': 'Summarise the quarterly zyxwvut figures.'}]})
+    conn = sqlite3.connect('ollama_workflows.db')
+    for table in ('search_index', 'search_documents', 'knowledge_chunk_index', 'knowledge_chunks'):
+        conn.execute(f"DROP TABLE {table}")
+    conn.commit()
+    conn.close()
+    start = time.perf_counter()
+    webui.init_db()
+    elapsed = time.perf_counter() - start
+    hits = [result['id'] for result in webui.full_text_search('zyxwvut')['results']]
+    if hits != ['rebuild-check']:
+        raise AssertionError(f"rebuilt index returned {hits}")
+    print(f"rebuilt the search index in {elapsed * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        webui.init_db()
+        start = time.perf_counter()
+        words = seed(args.documents)
+        print(f"indexed {args.documents} documents in {time.perf_counter() - start:.1f} s")
+
+        queries = {
+            'most common term (worst case)': words[0],
+            'common term': words[20],
+            'mid-frequency term': words[500],
+            'two mid-frequency terms': f"{words[300]} {words[800]}",
+            'rare term': words[15000],
+            'prefix': words[200][:3],
+            'no match': 'zzzzzzzzzz',
+        }
+        for label, query in queries.items():
+            for page in (1, 5):
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    result = webui.full_text_search(query, page=page)
+                    timings.append((time.perf_counter() - start) * 1000)
+                print(f"{label:<30} page {page}  {len(result['results']):3d} hits  "
+                      f"median {statistics.median(timings):7.2f} ms  max {max(timings):7.2f} ms")
+        rebuild()
+        os.chdir(REPO_ROOT)
+
+
+if __name__ == '__main__':
+    main()
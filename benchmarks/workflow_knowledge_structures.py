@@ -0,0 +1,101 @@
+"""Benchmark loading a workflow's knowledge structures with their children.
+
+Seeds a scratch database with parent structures that each have children, links
+every parent to one workflow, and times get_workflow_knowledge_structures
+against the previous one-query-per-parent implementation.
+
+    python benchmarks/workflow_knowledge_structures.py --parents 500 --children 20
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import webui  # noqa: E402
+
+
+def legacy_get_workflow_knowledge_structures(workflow_id):
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute("""
+        SELECT DISTINCT ks.id, ks.name, ks.content, ks.parent_id
+        FROM knowledge_structures ks
+        JOIN workflow_knowledge_structures wks ON ks.id = wks.structure_id
+        WHERE wks.workflow_id = ?
+    """, (workflow_id,))
+    structures = [{"id": row[0], "name": row[1], "content": row[2], "parent_id": row[3]} for row in c.fetchall()]
+    for structure in structures:
+        if structure['parent_id'] is None:
+            c.execute("SELECT id, name, content FROM knowledge_structures WHERE parent_id = ?", (structure['id'],))
+            children = [{"id": row[0], "name": row[1], "content": row[2]} for row in c.fetchall()]
+            structure['children'] = children
+            structure['full_content'] = structure['content'] + "\n\n" + "\n\n".join([child['content'] for child in children])
+        else:
+            structure['full_content'] = structure['content']
+    conn.close()
+    return structures
+
+
+def seed(parents, children):
+    conn = sqlite3.connect('ollama_workflows.db')
+    structures = []
+    for p in range(parents):
+        structures.append((f"parent-{p}", f"Parent {p}", f"Parent {p} content " * 20, None))
+        for ch in range(children):
+            structures.append((f"child-{p}-{ch}", f"Child {p}.{ch}", f"Child {p}.{ch} content " * 20, f"parent-{p}"))
+    conn.executemany("INSERT INTO knowledge_structures (id, name, content, parent_id) VALUES (?, ?, ?, ?)", structures)
+    conn.executemany("INSERT INTO workflow_knowledge_structures (workflow_id, structure_id) VALUES (?, ?)",
+                     [("bench", f"parent-{p}") for p in range(parents)])
+    c = conn.cursor()
+    for structure in structures:
+        webui.update_full_content(c, structure[0])
+    conn.commit()
+    conn.close()
+
+
+def measure(label, load, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load('bench')
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"{label:<32} median {statistics.median(timings):9.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--parents', type=int, default=500)
+    parser.add_argument('--children', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        webui.init_db()
+        seed(args.parents, args.children)
+        print(f"{args.parents} parents x {args.children} children linked to one workflow")
+
+        for legacy, current in zip(legacy_get_workflow_knowledge_structures('bench'),
+                                   webui.get_workflow_knowledge_structures('bench')):
+            assert legacy == {key: current[key] for key in legacy}
+
+        conn = sqlite3.connect('ollama_workflows.db')
+        conn.execute("DROP INDEX idx_knowledge_structures_parent_id")
+        conn.commit()
+        measure('per-parent queries, no index', legacy_get_workflow_knowledge_structures, args.repeat)
+        conn.execute("CREATE INDEX idx_knowledge_structures_parent_id ON knowledge_structures(parent_id)")
+        conn.commit()
+        conn.close()
+        measure('per-parent queries, indexed', legacy_get_workflow_knowledge_structures, args.repeat)
+        measure('single query, indexed', webui.get_workflow_knowledge_structures, args.repeat)
+        os.chdir(REPO_ROOT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Benchmark end-to-end workflow runs against a stand-in shortcuts executable.
+
+Starts the OSUI server in-process on a scratch database, with the Shortcuts and
+Ollama CLIs replaced by benchmarks/fake_cli.py, and runs each workflow through
+POST /api/run-workflow from several concurrent clients. Covers the bundled
+workflows in workflows/ plus a synthetic wide workflow (one branch step fanning
+out to --wide branches, then a merge) and a deep one (--deep sequential steps).
+Reports throughput and latency percentiles per workflow and saves them as JSON;
+pass an earlier results file with --compare to print the change.
+
+    python benchmarks/workflow_runs.py --runs 50 --concurrency 4 --latency 0.05 --output results.json
+    python benchmarks/workflow_runs.py --compare results.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import shlex
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# The executables are read when webui is imported
+FAKE_CLI = shlex.quote(os.path.join(REPO_ROOT, 'benchmarks', 'fake_cli.py'))
+os.environ.setdefault('OSUI_SHORTCUTS_BIN', f"{shlex.quote(sys.executable)} {FAKE_CLI} shortcuts")
+os.environ.setdefault('OSUI_OLLAMA_BIN', f"{shlex.quote(sys.executable)} {FAKE_CLI} ollama")
+
+import webui  # noqa: E402
+
+MODEL = 'llama3.1:latest'
+
+
+class QuietHandler(webui.OllamaHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def bundled_workflows():
+    workflows = []
+    for name in sorted(os.listdir(os.path.join(REPO_ROOT, 'workflows'))):
+        with open(os.path.join(REPO_ROOT, 'workflows', name)) as f:
+            workflows.append(webui.parse_imported_workflow(json.load(f)))
+    return workflows
+
+
+def wide_workflow(branches):
+    return {'id': 'bench-wide', 'name': f'Wide ({branches} branches)', 'steps': [
+        {'id': 'fan-out', 'name': 'Fan out', 'type': 'branch', 'branches': [
+            [{'id': f'branch-{i}', 'name': f'Branch {i}', 'type': 'normal', 'shortcutName': 'Benchmark Shortcut 0',
+              'model': MODEL, 'systemPrompt': 'Analyse the input.'}]
+            for i in range(branches)]},
+        {'id': 'merge', 'name': 'Merge', 'type': 'merge', 'branchStepIndex': 0,
+         'shortcutName': 'Benchmark Shortcut 1', 'model': MODEL, 'systemPrompt': 'Combine the branch outputs.'},
+    ]}
+
+
+def deep_workflow(steps):
+    return {'id': 'bench-deep', 'name': f'Deep ({steps} steps)', 'steps': [
+        {'id': f'step-{i}', 'name': f'Step {i}', 'type': 'normal', 'shortcutName': f'Benchmark Shortcut {i % 2}',
+         'model': MODEL, 'systemPrompt': 'Refine {{previous_output}}.'}
+        for i in range(steps)]}
+
+
+def count_steps(steps):
+    return sum(sum(len(branch) for branch in step['branches']) if step.get('type') == 'branch' else 1
+               for step in steps)
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    index = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def run_client(port, workflow_id, runs, timings, errors):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    body = json.dumps({'workflow_id': workflow_id, 'input': {'user_input': 'Benchmark input. ' * 20, 'model': MODEL}})
+    for _ in range(runs):
+        start = time.perf_counter()
+        conn.request('POST', '/api/run-workflow', body, {'Content-Type': 'application/json'})
+        result = json.loads(conn.getresponse().read())
+        elapsed = time.perf_counter() - start
+        if result.get('status') == 'completed':
+            timings.append(elapsed * 1000)
+        else:
+            errors.append(result.get('message'))
+    conn.close()
+
+
+def bench_workflow(port, workflow, runs, concurrency):
+    timings, errors = [], []
+    per_client = [runs // concurrency + (1 if i < runs % concurrency else 0) for i in range(concurrency)]
+    clients = [threading.Thread(target=run_client, args=(port, workflow['id'], n, timings, errors))
+               for n in per_client if n]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    wall = time.perf_counter() - start
+    timings.sort()
+    return {
+        'name': workflow['name'],
+        'steps': count_steps(workflow['steps']),
+        'runs': len(timings),
+        'errors': len(errors),
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(timings) / wall, 3) if wall else None,
+        'latency_ms': {
+            'mean': round(statistics.mean(timings), 2),
+            'p50': round(percentile(timings, 0.50), 2),
+            'p90': round(percentile(timings, 0.90), 2),
+            'p99': round(percentile(timings, 0.99), 2),
+            'max': round(timings[-1], 2),
+        } if timings else None,
+    }
+
+
+def print_results(results, baseline=None):
+    for workflow_id, result in results.items():
+        latency = result['latency_ms'] or {}
+        line = (f"{workflow_id:<36} {result['steps']:3d} steps  {result['throughput_rps']:8.2f} runs/s   "
+                f"p50 {latency.get('p50', 0):8.1f} ms  p90 {latency.get('p90', 0):8.1f} ms  "
+                f"p99 {latency.get('p99', 0):8.1f} ms")
+        if result['errors']:
+            line += f"  ({result['errors']} errors)"
+        previous = (baseline or {}).get(workflow_id)
+        if previous and previous['latency_ms'] and latency:
+            line += (f"   vs baseline: throughput {change(previous['throughput_rps'], result['throughput_rps'])}, "
+                     f"p50 {change(previous['latency_ms']['p50'], latency['p50'])}")
+        print(line)
+
+
+def change(before, after):
+    return f"{(after - before) / before * 100:+.1f}%" if before else 'n/a'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help='runs per workflow')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each fake shortcut run takes')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra uniform random latency, in seconds')
+    parser.add_argument('--output-bytes', type=int, default=512, help='bytes each fake shortcut run writes')
+    parser.add_argument('--wide', type=int, default=8, help='branches in the synthetic wide workflow')
+    parser.add_argument('--deep', type=int, default=10, help='steps in the synthetic deep workflow')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+    # Relative to where the script was started, not the scratch directory it runs in
+    args.output = args.output and os.path.abspath(args.output)
+    args.compare = args.compare and os.path.abspath(args.compare)
+
+    os.environ['FAKE_LATENCY'] = str(args.latency)
+    os.environ['FAKE_JITTER'] = str(args.jitter)
+    os.environ['FAKE_OUTPUT_BYTES'] = str(args.output_bytes)
+    webui.logging.disable(webui.logging.CRITICAL)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        webui.init_db()
+        workflows = bundled_workflows() + [wide_workflow(args.wide), deep_workflow(args.deep)]
+        for workflow in workflows:
+            webui.save_workflow(workflow)
+        httpd = webui.ThreadingHTTPServer(('127.0.0.1', 0), QuietHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        port = httpd.server_address[1]
+
+        print(f"{args.runs} runs per workflow, {args.concurrency} clients, "
+              f"{args.latency * 1000:.0f} ms (+{args.jitter * 1000:.0f} ms jitter) and {args.output_bytes} bytes per shortcut run")
+        results = {workflow['id']: bench_workflow(port, workflow, args.runs, args.concurrency) for workflow in workflows}
+        print_results(results, baseline)
+
+        httpd.shutdown()
+        os.chdir(REPO_ROOT)
+
+    if args.output:
+        report = {
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'cpu_count': os.cpu_count(), 'numpy': webui.np is not None},
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
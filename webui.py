@@ -1,25 +1,384 @@
 import json
+import sys
+import copy
 import subprocess
 import uuid
+import re
+import time
+import gzip
+import zlib
 import tempfile
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import shlex
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import sqlite3
 import os
 import logging
+import logging.handlers
+import atexit
+import contextvars
 import asyncio
 import threading
+import signal
 import queue
 from queue import Queue
-from urllib.parse import unquote_plus, parse_qs
-
-# Set up logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+from urllib.parse import unquote_plus, parse_qs, urlparse
+import urllib.request
+import urllib.error
+import socket
+import hashlib
+import html
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # Semantic retrieval falls back to pure-Python cosine search
+    np = None
+
+# Logging goes through a queue: request and runner threads only enqueue
+# records, and a listener thread formats and writes them. Records carry the
+# run, workflow and step ids of the code that logged them (see log_context).
+LOG_LEVEL = os.environ.get('OSUI_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('OSUI_LOG_FORMAT', 'json')
+LOG_PAYLOAD_BYTES = int(os.environ.get('OSUI_LOG_PAYLOAD_BYTES', 1024))
+LOG_CONTEXT_FIELDS = ('run_id', 'workflow_id', 'step_id')
+
+log_context = contextvars.ContextVar('log_context', default={})
+
+def set_log_context(**fields):
+    log_context.set({**log_context.get(), **fields})
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    # Runs on the thread that logged, where the context variable is visible. The
+    # record is only snapshotted here; the listener does the formatting
+    def prepare(self, record):
+        record = copy.copy(record)
+        for field, value in log_context.get().items():
+            setattr(record, field, value)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS + ('client',):
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        context = ' '.join(f"{field}={getattr(record, field)}" for field in LOG_CONTEXT_FIELDS
+                           if getattr(record, field, None) is not None)
+        return f"{message} [{context}]" if context else message
+
+def setup_logging():
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json'
+                                else TextFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+    queue_handler = ContextQueueHandler(queue.Queue())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+
+    def start_listener():
+        listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)  # flush what is still queued
+
+    def restart_in_child():
+        # A forked worker has no listener thread, and the old queue's lock may
+        # have been held at fork time
+        queue_handler.queue = queue.Queue()
+        start_listener()
+
+    start_listener()
+    os.register_at_fork(after_in_child=restart_in_child)
+
+def payload_preview(data):
+    # Logged request bodies are capped at OSUI_LOG_PAYLOAD_BYTES
+    if len(data) <= LOG_PAYLOAD_BYTES:
+        return data.decode('utf-8', 'replace')
+    return f"{data[:LOG_PAYLOAD_BYTES].decode('utf-8', 'replace')}... ({len(data) - LOG_PAYLOAD_BYTES} more bytes)"
+
+access_logger = logging.getLogger('osui.access')
+
+# Number of server processes; see serve_prefork
+WORKERS = int(os.environ.get('OSUI_WORKERS', 1))
+
+# Per-table change versions, bumped by the write functions and served as ETags.
+# The epoch keeps ETags from a previous server process from matching after a
+# restart. Pre-forked workers keep the versions in SQLite instead, so they all
+# serve the same ETags; there the epoch is chosen when the database is created.
+TABLE_VERSION_EPOCH = uuid.uuid4().hex[:8]
+table_versions = {'workflows': 0, 'shortcuts': 0, 'knowledge_structures': 0, 'user_prompts': 0}
+table_versions_lock = threading.Lock()
+
+def bump_table_version(table):
+    if WORKERS <= 1:
+        with table_versions_lock:
+            table_versions[table] += 1
+        return
+    conn = sqlite3.connect('ollama_workflows.db')
+    conn.execute("UPDATE table_versions SET version = version + 1 WHERE name = ?", (table,))
+    conn.commit()
+    conn.close()
 
-def init_db():
+def get_table_etag(table):
+    if WORKERS <= 1:
+        with table_versions_lock:
+            return f'W/"{table}-{TABLE_VERSION_EPOCH}-{table_versions[table]}"'
     conn = sqlite3.connect('ollama_workflows.db')
-    c = conn.cursor()
-    
-    # Create tables if they don't exist
+    epoch, version = conn.execute("SELECT epoch, version FROM table_versions WHERE name = ?", (table,)).fetchone()
+    conn.close()
+    return f'W/"{table}-{epoch}-{version}"'
+
+# The Shortcuts and Ollama CLIs; each may be a command with arguments, e.g. a
+# stand-in script for benchmarking on machines without them
+SHORTCUTS_COMMAND = shlex.split(os.environ.get('OSUI_SHORTCUTS_BIN', 'shortcuts'))
+OLLAMA_COMMAND = shlex.split(os.environ.get('OSUI_OLLAMA_BIN', 'ollama'))
+
+# JSON responses at least this large are gzipped for clients that accept it
+GZIP_MIN_SIZE = int(os.environ.get('OSUI_GZIP_MIN_SIZE', 1024))
+GZIP_LEVEL = int(os.environ.get('OSUI_GZIP_LEVEL', 6))
+
+compression_metrics = {'responses': 0, 'bytes_in': 0, 'bytes_out': 0, 'seconds': 0.0}
+compression_metrics_lock = threading.Lock()
+
+def accepts_gzip(accept_encoding):
+    # An explicit gzip entry decides; otherwise a * entry does
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        name = name.strip().lower()
+        if name not in ('gzip', '*'):
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.replace(' ', '').partition('=')
+            if key.lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+def gzip_body(body):
+    start = time.perf_counter()
+    compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    elapsed = time.perf_counter() - start
+    with compression_metrics_lock:
+        compression_metrics['responses'] += 1
+        compression_metrics['bytes_in'] += len(body)
+        compression_metrics['bytes_out'] += len(compressed)
+        compression_metrics['seconds'] += elapsed
+    return compressed, elapsed
+
+# Prometheus-style histograms served at /metrics. Each one keeps per-label
+# bucket counts, a sum and a count; label values are passed in label_names order.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        label_values = tuple(str(v) if v is not None else '' for v in label_values)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            series = [[list(labels), list(data['buckets']), data['sum'], data['count']]
+                      for labels, data in self.series.items()]
+        return {'help': self.help_text, 'labels': list(self.label_names), 'buckets': list(self.buckets), 'series': series}
+
+def render_histogram(name, histogram):
+    lines = [f"# HELP {name} {histogram['help']}", f"# TYPE {name} histogram"]
+    for label_values, buckets, total, count in sorted(histogram['series']):
+        labels = ','.join(f'{label}="{metric_label_value(value)}"' for label, value in zip(histogram['labels'], label_values))
+        prefix = f"{labels}," if labels else ''
+        for bound, bucket_count in zip(histogram['buckets'], buckets):
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {total}")
+        lines.append(f"{name}_count{{{labels}}} {count}")
+    return lines
+
+def metric_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+SHORTCUT_LABELS = ('workflow', 'step', 'shortcut', 'model')
+shortcut_queue_wait = Histogram('osui_shortcut_queue_wait_seconds',
+                                'Time from a step being scheduled to its shortcut process being started.',
+                                SHORTCUT_LABELS, SECONDS_BUCKETS)
+shortcut_spawn = Histogram('osui_shortcut_spawn_seconds', 'Time taken to start the shortcuts process.',
+                           SHORTCUT_LABELS, SECONDS_BUCKETS)
+shortcut_execution = Histogram('osui_shortcut_execution_seconds', 'Time from process start to exit.',
+                               SHORTCUT_LABELS, SECONDS_BUCKETS)
+shortcut_output_size = Histogram('osui_shortcut_output_bytes', 'Size of shortcut output.',
+                                 SHORTCUT_LABELS, BYTES_BUCKETS)
+shortcut_failures = Histogram('osui_shortcut_failure_seconds', 'Duration of shortcut runs that failed.',
+                              SHORTCUT_LABELS, SECONDS_BUCKETS)
+http_request_duration = Histogram('osui_http_request_duration_seconds',
+                                  'HTTP request latency by route; event streams count until they close.',
+                                  ('method', 'route', 'status'), SECONDS_BUCKETS)
+scheduler_wait = Histogram('osui_scheduler_wait_seconds', 'Time shortcut runs waited for a scheduler slot.',
+                           ('priority',), SECONDS_BUCKETS)
+METRIC_HISTOGRAMS = [shortcut_queue_wait, shortcut_spawn, shortcut_execution, shortcut_output_size,
+                     shortcut_failures, http_request_duration, scheduler_wait]
+
+# Routes are labelled by their fixed prefix so ids in the path don't create new series
+METRIC_ROUTES = (
+    '/api/workflows', '/api/workflow-details/', '/api/run-workflow', '/workflows', '/get-workflow/',
+    '/export-workflow/', '/steps', '/shortcuts', '/knowledge-structures', '/run-workflow/', '/run-shortcut/',
+    '/search', '/scheduler', '/agents', '/agents/', '/runs', '/runs/', '/run-trace/', '/admin/profile', '/ollama-models', '/discovery-status', '/user-prompts', '/user-prompt/', '/metrics',
+    '/save-workflow', '/save-form/', '/refresh-shortcuts', '/update-shortcut-description', '/update-step/',
+    '/add-knowledge-structure', '/save-settings', '/save-user-prompt', '/import-workflow',
+    '/delete-knowledge-structure/', '/delete-user-prompt/', '/delete-workflow/',
+)
+
+def metric_route(path):
+    path = urlparse(path).path
+    if path == '/':
+        return '/'
+    for route in METRIC_ROUTES:
+        if path == route or (route.endswith('/') and path.startswith(route)):
+            return route
+    return 'other'
+
+def metrics_snapshot():
+    # This process's metrics as JSON-compatible data; gauges and counters map
+    # their label string to a value. Values marked 'max' are the same setting
+    # in every worker, so merging keeps one instead of summing them
+    values = {}
+
+    def add(name, kind, help_text, samples, merge='sum'):
+        values[name] = {'kind': kind, 'help': help_text, 'samples': samples, 'merge': merge}
+
+    scheduler = shortcut_scheduler.status()
+    for key, help_text in (('queued', 'Shortcut runs waiting for a slot.'), ('running', 'Shortcut runs holding a slot.')):
+        add(f"osui_scheduler_{key}", 'gauge', help_text,
+            {f'priority="{priority}"': data[key] for priority, data in scheduler['classes'].items()})
+    runs = run_admission.status()
+    for key, kind, help_text in (('active', 'gauge', 'Workflow runs admitted and not yet finished.'),
+                                 ('limit', 'gauge', 'Maximum active workflow runs.'),
+                                 ('admitted', 'counter', 'Workflow runs admitted.'),
+                                 ('rejected', 'counter', 'Workflow runs rejected with 429.')):
+        add(f"osui_runs_{key}" + ('_total' if kind == 'counter' else ''), kind, help_text, {'': runs[key]},
+            'max' if key == 'limit' else 'sum')
+    with compression_metrics_lock:
+        compression = dict(compression_metrics)
+    for key, help_text in (('responses', 'Responses gzipped.'), ('bytes_in', 'Bytes before gzip.'),
+                           ('bytes_out', 'Bytes after gzip.'), ('seconds', 'Time spent gzipping.')):
+        add(f"osui_gzip_{key}_total", 'counter', help_text, {'': compression[key]})
+    return {'histograms': {histogram.name: histogram.snapshot() for histogram in METRIC_HISTOGRAMS}, 'values': values}
+
+def merge_metrics(snapshots):
+    # Sums the snapshots of several worker processes
+    merged = {'histograms': {}, 'values': {}}
+    for snapshot in snapshots:
+        for name, histogram in snapshot['histograms'].items():
+            target = merged['histograms'].setdefault(name, {**histogram, 'series': {}})
+            for label_values, buckets, total, count in histogram['series']:
+                key = tuple(label_values)
+                if key in target['series']:
+                    previous = target['series'][key]
+                    buckets = [a + b for a, b in zip(previous[1], buckets)]
+                    total, count = previous[2] + total, previous[3] + count
+                target['series'][key] = [label_values, buckets, total, count]
+        for name, value in snapshot['values'].items():
+            target = merged['values'].setdefault(name, {**value, 'samples': {}})
+            for labels, sample in value['samples'].items():
+                if labels in target['samples'] and value.get('merge') == 'max':
+                    sample = max(target['samples'][labels], sample)
+                elif labels in target['samples']:
+                    sample += target['samples'][labels]
+                target['samples'][labels] = sample
+    for histogram in merged['histograms'].values():
+        histogram['series'] = list(histogram['series'].values())
+    return merged
+
+def render_metrics(snapshot=None):
+    snapshot = snapshot or metrics_snapshot()
+    lines = []
+    for name, histogram in snapshot['histograms'].items():
+        lines.extend(render_histogram(name, histogram))
+    for name, value in snapshot['values'].items():
+        lines += [f"# HELP {name} {value['help']}", f"# TYPE {name} {value['kind']}"]
+        lines += [f"{name}{{{labels}}} {sample}" if labels else f"{name} {sample}"
+                  for labels, sample in value['samples'].items()]
+    return "\n".join(lines) + "\n"
+
+# On-demand sampling profiler. Nothing runs until /admin/profile is requested;
+# the request thread then snapshots every other thread's stack at a fixed
+# interval and returns the counts as collapsed stacks (flamegraph.pl, speedscope).
+# Admin endpoints need OSUI_ADMIN_TOKEN as a bearer token, or a loopback client
+# when no token is set.
+ADMIN_TOKEN = os.environ.get('OSUI_ADMIN_TOKEN')
+PROFILE_MAX_SECONDS = 300
+profile_lock = threading.Lock()
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+def profile_stacks(seconds, interval):
+    counts = {}
+    samples = 0
+    current = threading.get_ident()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}").replace(';', ':'))
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+def collapsed_stacks(counts):
+    return ''.join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+# Schema migrations, applied in order. PRAGMA user_version records how many have
+# run, so each one runs exactly once per database. Append new migrations; never
+# edit or reorder released ones.
+def migrate_base_tables(c):
     c.execute('''CREATE TABLE IF NOT EXISTS workflows
                  (id TEXT PRIMARY KEY, name TEXT, steps TEXT, 
                   form_definition TEXT, user_prompts TEXT,
@@ -36,7 +395,7 @@ def init_db():
                  FOREIGN KEY (workflow_id) REFERENCES workflows(id),
                  FOREIGN KEY (structure_id) REFERENCES knowledge_structures(id))''')
     
-    # Check if columns exist and add them if they don't
+    # Databases from before migrations may lack later workflow columns
     c.execute("PRAGMA table_info(workflows)")
     columns = [column[1] for column in c.fetchall()]
     
@@ -48,32 +407,456 @@ def init_db():
         c.execute("ALTER TABLE workflows ADD COLUMN form_definition TEXT")
     if 'user_prompts' not in columns:
         c.execute("ALTER TABLE workflows ADD COLUMN user_prompts TEXT")
+
+def migrate_full_content(c):
+    c.execute("PRAGMA table_info(knowledge_structures)")
+    columns = [column[1] for column in c.fetchall()]
+
+    if 'full_content' not in columns:
+        c.execute("ALTER TABLE knowledge_structures ADD COLUMN full_content TEXT")
+    if 'full_content_size' not in columns:
+        c.execute("ALTER TABLE knowledge_structures ADD COLUMN full_content_size INTEGER")
+
+    c.execute("SELECT id FROM knowledge_structures WHERE full_content IS NULL")
+    for (structure_id,) in c.fetchall():
+        update_full_content(c, structure_id)
+
+def migrate_query_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_structures_parent_id ON knowledge_structures(parent_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_knowledge_structures_structure_id ON workflow_knowledge_structures(structure_id)")
+
+    # Shortcuts are addressed by name: collapse duplicate names (keeping the
+    # latest row), give every row an id, then make the name unique
+    c.execute("DELETE FROM shortcuts WHERE rowid NOT IN (SELECT MAX(rowid) FROM shortcuts GROUP BY name)")
+    c.execute("SELECT rowid FROM shortcuts WHERE id IS NULL")
+    c.executemany("UPDATE shortcuts SET id = ? WHERE rowid = ?", [(str(uuid.uuid4()), row[0]) for row in c.fetchall()])
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_shortcuts_name ON shortcuts(name)")
+
+def migrate_embeddings(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS embeddings
+                 (content_hash TEXT, model TEXT, dimensions INTEGER, vector BLOB,
+                 PRIMARY KEY (content_hash, model))''')
+
+def migrate_search_index(c):
+    global search_enabled
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(title, body, tokenize = 'porter unicode61')")
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Full-text search disabled, SQLite has no FTS5 support: {str(e)}")
+        return
+    c.execute('''CREATE TABLE IF NOT EXISTS search_documents
+                 (id INTEGER PRIMARY KEY, kind TEXT, doc_id TEXT, UNIQUE (kind, doc_id))''')
+    # Knowledge structures are also split into chunks for retrieval-mode steps
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_chunk_index USING fts5(content, tokenize = 'porter unicode61')")
+    c.execute('''CREATE TABLE IF NOT EXISTS knowledge_chunks
+                 (id INTEGER PRIMARY KEY, structure_id TEXT, chunk_index INTEGER, content TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_chunks_structure_id ON knowledge_chunks(structure_id)")
+    search_enabled = True
+
+    # Index everything written before the search index existed
+    c.execute("DELETE FROM search_documents")
+    c.execute("DELETE FROM search_index")
+    c.execute("DELETE FROM knowledge_chunks")
+    c.execute("DELETE FROM knowledge_chunk_index")
+    c.execute("SELECT id, name, content FROM knowledge_structures")
+    for row in c.fetchall():
+        index_search_document(c, 'knowledge_structure', row[0], row[1], row[2])
+        index_knowledge_chunks(c, row[0], row[2])
+    c.execute("SELECT id, name, content FROM user_prompts")
+    for row in c.fetchall():
+        index_search_document(c, 'user_prompt', row[0], row[1], row[2])
+    c.execute("SELECT id, name, steps FROM workflows")
+    for workflow_id, name, steps in c.fetchall():
+        if steps is not None:
+            body = workflow_search_text(json.loads(steps))
+        else:
+            # Past migrate_workflow_steps the steps live in workflow_steps
+            c.execute("SELECT system_prompt FROM workflow_steps WHERE workflow_id = ? ORDER BY position, branch_index, branch_position",
+                      (workflow_id,))
+            body = "\n\n".join(r[0] for r in c.fetchall() if r[0])
+        index_search_document(c, 'workflow', workflow_id, name, body)
+
+def migrate_workflow_steps(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS workflow_steps
+                 (workflow_id TEXT, position INTEGER, branch_index INTEGER, branch_position INTEGER,
+                  step_id TEXT, name TEXT, type TEXT, shortcut_name TEXT, model TEXT, system_prompt TEXT,
+                  branch_count INTEGER, data TEXT,
+                  PRIMARY KEY (workflow_id, position, branch_index, branch_position))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_steps_model ON workflow_steps(model)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_steps_shortcut_name ON workflow_steps(shortcut_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_steps_step_id ON workflow_steps(workflow_id, step_id)")
+
+    # Move each workflow's steps blob into rows
+    c.execute("SELECT id, steps FROM workflows WHERE steps IS NOT NULL")
+    for workflow_id, steps in c.fetchall():
+        c.executemany('''INSERT OR REPLACE INTO workflow_steps
+                         (workflow_id, position, branch_index, branch_position, step_id, name, type,
+                          shortcut_name, model, system_prompt, branch_count, data)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      flatten_workflow_steps(workflow_id, json.loads(steps)))
+    c.execute("UPDATE workflows SET steps = NULL")
+
+def migrate_workflow_runs(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS workflow_runs
+                 (id TEXT PRIMARY KEY, workflow_id TEXT, status TEXT,
+                  started_at REAL, ended_at REAL, trace TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_runs_workflow ON workflow_runs(workflow_id, started_at)")
+
+def migrate_run_history(c):
+    for column in ('input BLOB', 'input_encoding TEXT', 'error TEXT', 'step_count INTEGER', 'stored_bytes INTEGER'):
+        c.execute(f"ALTER TABLE workflow_runs ADD COLUMN {column}")
+    c.execute('''CREATE TABLE IF NOT EXISTS run_steps
+                 (id INTEGER PRIMARY KEY, run_id TEXT, step_number INTEGER, step_id TEXT, name TEXT,
+                  status TEXT, started_at REAL, ended_at REAL, output BLOB, output_encoding TEXT,
+                  output_size INTEGER)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_run_steps_run ON run_steps(run_id, step_number)")
+    # Keyset pagination walks these newest first
+    c.execute("DROP INDEX IF EXISTS idx_workflow_runs_workflow")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_runs_started ON workflow_runs(started_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_workflow_runs_workflow_started ON workflow_runs(workflow_id, started_at, id)")
+
+def migrate_shared_state(c):
+    c.execute("CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, epoch TEXT, version INTEGER)")
+    epoch = uuid.uuid4().hex[:8]
+    c.executemany("INSERT OR IGNORE INTO table_versions (name, epoch, version) VALUES (?, ?, 0)",
+                  [(table, epoch) for table in ('workflows', 'shortcuts', 'knowledge_structures', 'user_prompts')])
+    c.execute("CREATE TABLE IF NOT EXISTS run_events (id INTEGER PRIMARY KEY, run_id TEXT, data TEXT)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_run_events_run ON run_events(run_id, id)")
+    c.execute("ALTER TABLE workflow_runs ADD COLUMN worker INTEGER")
+    c.execute("ALTER TABLE workflow_runs ADD COLUMN cancel_requested INTEGER DEFAULT 0")
+    c.execute("CREATE TABLE IF NOT EXISTS worker_metrics (worker INTEGER PRIMARY KEY, updated_at REAL, data TEXT)")
+
+def migrate_agents(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS agents
+                 (id TEXT PRIMARY KEY, name TEXT, shortcuts TEXT, models TEXT, slots INTEGER, load REAL,
+                  registered_at REAL, last_seen REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS agent_jobs
+                 (id TEXT PRIMARY KEY, agent_id TEXT, shortcut_name TEXT, model TEXT, priority TEXT, payload TEXT,
+                  status TEXT, output TEXT, error TEXT, created_at REAL, claimed_at REAL, finished_at REAL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_agent_jobs_agent ON agent_jobs(agent_id, status, created_at)")
+
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_full_content,
+    migrate_query_indexes,
+    migrate_embeddings,
+    migrate_search_index,
+    migrate_workflow_steps,
+    migrate_workflow_runs,
+    migrate_run_history,
+    migrate_shared_state,
+    migrate_agents,
+]
+
+def init_db():
+    global search_enabled
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+
+    # WAL lets worker processes and threads read while another writes
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA user_version")
+    schema_version = c.fetchone()[0]
+    for version, migration in enumerate(MIGRATIONS[schema_version:], start=schema_version + 1):
+        try:
+            c.execute("BEGIN")
+            migration(c)
+            c.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            conn.close()
+            raise RuntimeError(f"Schema migration {version} ({migration.__name__}) failed: {str(e)}") from e
+        logging.info(f"Applied schema migration {version}: {migration.__name__}")
+
+    # A database migrated without FTS5 support gets its search index once
+    # SQLite has it; until then search stays off
+    try:
+        c.execute("SELECT 1 FROM search_index LIMIT 0")
+        search_enabled = True
+    except sqlite3.OperationalError:
+        search_enabled = False
+        if MIGRATIONS.index(migrate_search_index) < schema_version:
+            try:
+                c.execute("BEGIN")
+                migrate_search_index(c)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                conn.close()
+                raise RuntimeError(f"Creating the search index failed: {str(e)}") from e
+            if search_enabled:
+                logging.info("Created the search index")
     
-    conn.commit()
     conn.close()
 
-def get_workflows():
+# Full-text search over knowledge structures, user prompts and workflows. Each
+# document has a row in search_documents whose id is the rowid of its FTS5 entry.
+search_enabled = False
+
+def workflow_search_text(steps):
+    prompts = []
+    for step in steps:
+        if isinstance(step, dict) and step.get('type') == 'branch':
+            prompts.extend(branch_step.get('systemPrompt', '') for branch in step['branches'] for branch_step in branch)
+        elif isinstance(step, dict):
+            prompts.append(step.get('systemPrompt', ''))
+    return "\n\n".join(prompt for prompt in prompts if prompt)
+
+def index_search_document(c, kind, doc_id, title, body):
+    if not search_enabled:
+        return
+    c.execute("SELECT id FROM search_documents WHERE kind = ? AND doc_id = ?", (kind, doc_id))
+    row = c.fetchone()
+    if row:
+        rowid = row[0]
+        c.execute("DELETE FROM search_index WHERE rowid = ?", (rowid,))
+    else:
+        c.execute("INSERT INTO search_documents (kind, doc_id) VALUES (?, ?)", (kind, doc_id))
+        rowid = c.lastrowid
+    c.execute("INSERT INTO search_index (rowid, title, body) VALUES (?, ?, ?)", (rowid, title or '', body or ''))
+
+def remove_search_document(c, kind, doc_id):
+    if not search_enabled:
+        return
+    c.execute("SELECT id FROM search_documents WHERE kind = ? AND doc_id = ?", (kind, doc_id))
+    row = c.fetchone()
+    if row:
+        c.execute("DELETE FROM search_index WHERE rowid = ?", (row[0],))
+        c.execute("DELETE FROM search_documents WHERE id = ?", (row[0],))
+
+def build_search_query(text):
+    # Treat user input as plain terms: quote each one so FTS5 syntax characters
+    # can't break the query, and prefix-match the last term for search-as-you-type
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def full_text_search(text, kind=None, page=1, limit=20):
+    match = build_search_query(text)
+    if not match:
+        return {"query": text, "page": page, "limit": limit, "has_more": False, "results": []}
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    # Rank first, with titles weighing ten times as much as bodies; snippets are
+    # only built for the page being returned. Snippets are HTML: the document
+    # text is escaped, then the match markers become <mark> tags
+    c.execute(f"""
+        SELECT search_index.rowid, bm25(search_index, 10.0, 1.0) AS rank
+        FROM search_index
+        {"JOIN search_documents d ON d.id = search_index.rowid" if kind else ""}
+        WHERE search_index MATCH ? {"AND d.kind = ?" if kind else ""}
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+    """, (match, *([kind] if kind else []), limit + 1, (page - 1) * limit))
+    ranked = c.fetchall()
+    scores = {rowid: -rank for rowid, rank in ranked[:limit]}
+    rows = {}
+    if scores:
+        c.execute(f"""
+            SELECT search_index.rowid, d.kind, d.doc_id, search_index.title,
+                   snippet(search_index, 1, char(2), char(3), '…', 16)
+            FROM search_index
+            JOIN search_documents d ON d.id = search_index.rowid
+            WHERE search_index MATCH ? AND search_index.rowid IN ({", ".join("?" * len(scores))})
+        """, (match, *scores))
+        rows = {row[0]: row for row in c.fetchall()}
+    conn.close()
+    results = [{"kind": rows[rowid][1], "id": rows[rowid][2], "title": rows[rowid][3],
+                "snippet": html.escape(rows[rowid][4]).replace('\x02', '<mark>').replace('\x03', '</mark>'), "score": score}
+               for rowid, score in scores.items()]
+    return {"query": text, "page": page, "limit": limit, "has_more": len(ranked) > limit, "results": results}
+
+# Steps are stored one row per step in workflow_steps. Top-level steps have
+# branch_index and branch_position -1; the steps inside a branch step share its
+# position and carry their branch and place within it. The JSON steps list is
+# rebuilt from the rows for the API and exports.
+def flatten_workflow_steps(workflow_id, steps):
+    rows = []
+
+    def step_row(step, position, branch_index, branch_position):
+        is_dict = isinstance(step, dict)
+        data = {k: v for k, v in step.items() if k != 'branches'} if is_dict else step
+        get = step.get if is_dict else (lambda key, default=None: default)
+        return (workflow_id, position, branch_index, branch_position,
+                get('id'), get('name'), get('type'), get('shortcutName'), get('model'), get('systemPrompt'),
+                len(step['branches']) if is_dict and step.get('type') == 'branch' else None,
+                json.dumps(data))
+
+    for position, step in enumerate(steps):
+        rows.append(step_row(step, position, -1, -1))
+        if isinstance(step, dict) and step.get('type') == 'branch':
+            for branch_index, branch in enumerate(step['branches']):
+                for branch_position, branch_step in enumerate(branch):
+                    rows.append(step_row(branch_step, position, branch_index, branch_position))
+    return rows
+
+def assemble_workflow_steps(rows):
+    # rows: (position, branch_index, branch_position, branch_count, data) in key order
+    steps = []
+    for position, branch_index, branch_position, branch_count, data in rows:
+        step = json.loads(data)
+        if branch_index == -1:
+            if branch_count is not None:
+                step['branches'] = [[] for _ in range(branch_count)]
+            steps.append(step)
+        else:
+            steps[-1]['branches'][branch_index].append(step)
+    return steps
+
+# Stands in for a WorkflowRecord column that was not selected; it is read from
+# the database when first accessed
+DEFERRED = object()
+
+class WorkflowRecord:
+    # A workflow row whose JSON columns (the step rows and form_definition) are
+    # only decoded when first read, then cached. Supports the dict operations
+    # the handlers use; json_default serializes it.
+    __slots__ = ('_values', '_raw')
+
+    def __init__(self, values, raw):
+        self._values = values
+        self._raw = raw
+
+    def _decode(self, key):
+        raw = self._raw.pop(key)
+        if raw is DEFERRED:
+            raw = load_workflow_column(self._values['id'], key)
+        if key == 'steps':
+            self._values[key] = assemble_workflow_steps(raw)
+        else:
+            self._values[key] = json.loads(raw) if raw else None
+
+    def __getitem__(self, key):
+        if key in self._raw:
+            self._decode(key)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._raw.pop(key, None)
+        self._values[key] = value
+
+    def __contains__(self, key):
+        return key in self._values or key in self._raw
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self._values) + list(self._raw)
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+def json_default(obj):
+    if isinstance(obj, WorkflowRecord):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def load_workflow_column(workflow_id, key):
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    if key == 'steps':
+        c.execute('''SELECT position, branch_index, branch_position, branch_count, data FROM workflow_steps
+                     WHERE workflow_id = ? ORDER BY position, branch_index, branch_position''', (workflow_id,))
+        value = c.fetchall()
+    else:
+        c.execute("SELECT form_definition FROM workflows WHERE id = ?", (workflow_id,))
+        row = c.fetchone()
+        value = row[0] if row else None
+    conn.close()
+    return value
+
+def load_workflows(c, workflow_id=None, with_steps=True):
+    # Without steps only the summary columns are read; steps and the form
+    # definition are then loaded per workflow when accessed
+    where = "WHERE id = ?" if workflow_id else ""
+    if not with_steps:
+        c.execute(f"SELECT id, name, import_format, version FROM workflows {where}",
+                  (workflow_id,) if workflow_id else ())
+        return [WorkflowRecord({"id": row[0], "name": row[1], "import_format": row[2], "version": row[3]},
+                               {"steps": DEFERRED, "form_definition": DEFERRED})
+                for row in c.fetchall()]
+    c.execute(f"SELECT id, name, form_definition, import_format, version FROM workflows {where}",
+              (workflow_id,) if workflow_id else ())
+    rows = c.fetchall()
+    steps_by_workflow = {}
+    c.execute(f"""
+        SELECT workflow_id, position, branch_index, branch_position, branch_count, data
+        FROM workflow_steps {"WHERE workflow_id = ?" if workflow_id else ""}
+        ORDER BY workflow_id, position, branch_index, branch_position
+    """, (workflow_id,) if workflow_id else ())
+    for row in c.fetchall():
+        steps_by_workflow.setdefault(row[0], []).append(row[1:])
+    return [WorkflowRecord({"id": row[0], "name": row[1], "import_format": row[3], "version": row[4]},
+                           {"steps": steps_by_workflow.get(row[0], []), "form_definition": row[2]})
+            for row in rows]
+
+def get_workflows(with_steps=True):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("SELECT id, name, steps, form_definition, import_format, version FROM workflows")
-    workflows = [{"id": row[0], "name": row[1], "steps": json.loads(row[2]), 
-                  "form_definition": json.loads(row[3]) if row[3] else None,
-                  "import_format": row[4], "version": row[5]} for row in c.fetchall()]
+    workflows = load_workflows(c, with_steps=with_steps)
     conn.close()
     return workflows
 
+def get_workflow(workflow_id):
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    workflows = load_workflows(c, workflow_id)
+    conn.close()
+    return workflows[0] if workflows else None
+
+def export_workflow(workflow_id):
+    # The JSON import format, so an export can be re-imported as is
+    workflow = get_workflow(workflow_id)
+    return {"workflow": workflow} if workflow else None
+
+def validate_retrieval(step):
+    # Retrieval numbers are used as integers when the step runs, so bad values
+    # are rejected when the workflow is saved
+    retrieval = step.get('retrieval') if isinstance(step, dict) else None
+    for key in ('top_k', 'token_budget'):
+        value = (retrieval or {}).get(key)
+        if value is None:
+            continue
+        try:
+            valid = int(value) >= 1
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            raise ValueError(f"Step {step.get('id')}: retrieval {key} must be a positive integer, not {value!r}")
+
+def validate_workflow_steps(steps):
+    for step in steps:
+        validate_retrieval(step)
+        if isinstance(step, dict) and step.get('type') == 'branch':
+            for branch in step.get('branches', []):
+                validate_workflow_steps(branch)
+
 def save_workflow(workflow):
+    validate_workflow_steps(workflow.get('steps', []))
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
 
     try:
         c.execute('''INSERT OR REPLACE INTO workflows 
                      (id, name, steps, form_definition, import_format, version) 
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                  (workflow['id'], workflow['name'], json.dumps(workflow['steps']),
+                     VALUES (?, ?, NULL, ?, ?, ?)''',
+                  (workflow['id'], workflow['name'],
                    json.dumps(workflow.get('form_definition')),
                    workflow.get('import_format'),
                    workflow.get('version')))
+        c.execute("DELETE FROM workflow_steps WHERE workflow_id = ?", (workflow['id'],))
+        c.executemany('''INSERT INTO workflow_steps
+                         (workflow_id, position, branch_index, branch_position, step_id, name, type,
+                          shortcut_name, model, system_prompt, branch_count, data)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      flatten_workflow_steps(workflow['id'], workflow['steps']))
 
         # Save knowledge structure associations
         if 'knowledge_structures' in workflow:
@@ -82,12 +865,80 @@ def save_workflow(workflow):
                 c.execute("INSERT INTO workflow_knowledge_structures (workflow_id, structure_id) VALUES (?, ?)",
                           (workflow['id'], structure_id))
 
+        index_search_document(c, 'workflow', workflow['id'], workflow['name'], workflow_search_text(workflow['steps']))
+        conn.commit()
+        bump_table_version('workflows')
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+
+def update_workflow_step(workflow_id, step_id, changes):
+    # Rewrites a single step row rather than the whole workflow. Changing a
+    # step's type reshapes the workflow, so that needs a full save
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+
+    try:
+        c.execute("SELECT rowid, data FROM workflow_steps WHERE workflow_id = ? AND step_id = ?", (workflow_id, step_id))
+        rows = c.fetchall()
+        if not rows:
+            return None
+        if len(rows) > 1:
+            raise ValueError(f"Step id {step_id} is used by {len(rows)} steps of this workflow")
+        row = rows[0]
+        step = json.loads(row[1])
+        if 'type' in changes and changes['type'] != step.get('type'):
+            raise ValueError("A step's type can only be changed by saving the whole workflow")
+        step.update({k: v for k, v in changes.items() if k not in ('id', 'branches')})
+        validate_retrieval(step)
+        c.execute('''UPDATE workflow_steps SET name = ?, type = ?, shortcut_name = ?, model = ?, system_prompt = ?, data = ?
+                     WHERE rowid = ?''',
+                  (step.get('name'), step.get('type'), step.get('shortcutName'), step.get('model'),
+                   step.get('systemPrompt'), json.dumps(step), row[0]))
+        if 'systemPrompt' in changes or 'name' in changes:
+            c.execute("SELECT name FROM workflows WHERE id = ?", (workflow_id,))
+            name = c.fetchone()[0]
+            c.execute("SELECT system_prompt FROM workflow_steps WHERE workflow_id = ? ORDER BY position, branch_index, branch_position",
+                      (workflow_id,))
+            index_search_document(c, 'workflow', workflow_id, name, "\n\n".join(r[0] for r in c.fetchall() if r[0]))
         conn.commit()
     except Exception as e:
         conn.rollback()
         raise e
     finally:
         conn.close()
+    bump_table_version('workflows')
+    return step
+
+def find_workflow_steps(model=None, shortcut_name=None):
+    # Indexed lookups such as "every step that uses llama3.1:latest"
+    conditions, params = [], []
+    if model:
+        conditions.append("s.model = ?")
+        params.append(model)
+    if shortcut_name:
+        conditions.append("s.shortcut_name = ?")
+        params.append(shortcut_name)
+    if not conditions:
+        return []
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT s.workflow_id, w.name, s.step_id, s.name, s.type, s.shortcut_name, s.model,
+               s.position, s.branch_index, s.branch_position
+        FROM workflow_steps s
+        JOIN workflows w ON w.id = s.workflow_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY s.workflow_id, s.position, s.branch_index, s.branch_position
+    """, params)
+    steps = [{"workflow_id": row[0], "workflow_name": row[1], "step_id": row[2], "name": row[3], "type": row[4],
+              "shortcutName": row[5], "model": row[6], "position": row[7],
+              "branch": row[8] if row[8] >= 0 else None, "branch_position": row[9] if row[9] >= 0 else None}
+             for row in c.fetchall()]
+    conn.close()
+    return steps
 
 def parse_imported_workflow(import_data):
     try:
@@ -117,15 +968,17 @@ def get_shortcuts():
 def save_shortcut(shortcut):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO shortcuts (name, description) VALUES (?, ?)",
-              (shortcut['name'], shortcut['description']))
+    c.execute('''INSERT INTO shortcuts (id, name, description) VALUES (?, ?, ?)
+                 ON CONFLICT (name) DO UPDATE SET description = excluded.description''',
+              (shortcut.get('id') or str(uuid.uuid4()), shortcut['name'], shortcut['description']))
     conn.commit()
     conn.close()
+    bump_table_version('shortcuts')
 
 def get_knowledge_structures():
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("SELECT * FROM knowledge_structures")
+    c.execute("SELECT id, name, content, parent_id FROM knowledge_structures")
     structures = [{"id": row[0], "name": row[1], "content": row[2], "parent_id": row[3]} for row in c.fetchall()]
     conn.close()
     return structures
@@ -133,12 +986,12 @@ def get_knowledge_structures():
 def get_knowledge_structure(structure_id):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("SELECT * FROM knowledge_structures WHERE id = ?", (structure_id,))
+    c.execute("SELECT id, name, content, parent_id FROM knowledge_structures WHERE id = ?", (structure_id,))
     row = c.fetchone()
     if row:
         structure = {"id": row[0], "name": row[1], "content": row[2], "parent_id": row[3]}
         # Fetch child structures
-        c.execute("SELECT * FROM knowledge_structures WHERE parent_id = ?", (structure_id,))
+        c.execute("SELECT id, name, content, parent_id FROM knowledge_structures WHERE parent_id = ?", (structure_id,))
         children = [{"id": r[0], "name": r[1], "content": r[2], "parent_id": r[3]} for r in c.fetchall()]
         structure["children"] = children
         conn.close()
@@ -146,37 +999,352 @@ def get_knowledge_structure(structure_id):
     conn.close()
     return None
 
+def update_full_content(c, structure_id):
+    # full_content is a parent's content followed by its children's, so it is
+    # rebuilt whenever the structure or one of its children is written. Rows
+    # from older databases may have NULL content
+    c.execute("SELECT content, parent_id FROM knowledge_structures WHERE id = ?", (structure_id,))
+    row = c.fetchone()
+    if not row:
+        return
+    content, parent_id = row[0] or '', row[1]
+    if parent_id is None:
+        c.execute("SELECT content FROM knowledge_structures WHERE parent_id = ? ORDER BY rowid", (structure_id,))
+        full_content = content + "\n\n" + "\n\n".join([r[0] for r in c.fetchall() if r[0] is not None])
+    else:
+        full_content = content
+    c.execute("UPDATE knowledge_structures SET full_content = ?, full_content_size = ? WHERE id = ?",
+              (full_content, len(full_content.encode('utf-8')), structure_id))
+
+# Retrieval mode: structures are split into chunks of roughly this many tokens
+KNOWLEDGE_CHUNK_TOKENS = int(os.environ.get('OSUI_CHUNK_TOKENS', 200))
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+def chunk_text(text, max_tokens=KNOWLEDGE_CHUNK_TOKENS):
+    # Pack paragraphs into chunks of about max_tokens, splitting overlong
+    # paragraphs on word boundaries
+    chunks = []
+    current = ''
+    for paragraph in (p.strip() for p in (text or '').split('\n\n')):
+        if not paragraph:
+            continue
+        pieces = [paragraph]
+        if estimate_tokens(paragraph) > max_tokens:
+            pieces, piece = [], ''
+            for word in paragraph.split():
+                if piece and estimate_tokens(piece + ' ' + word) > max_tokens:
+                    pieces.append(piece)
+                    piece = word
+                else:
+                    piece = f"{piece} {word}" if piece else word
+            if piece:
+                pieces.append(piece)
+        for piece in pieces:
+            if current and estimate_tokens(current + '\n\n' + piece) > max_tokens:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def remove_knowledge_chunks(c, structure_id):
+    if not search_enabled:
+        return
+    c.execute("SELECT id FROM knowledge_chunks WHERE structure_id = ?", (structure_id,))
+    chunk_ids = [(row[0],) for row in c.fetchall()]
+    c.executemany("DELETE FROM knowledge_chunk_index WHERE rowid = ?", chunk_ids)
+    c.execute("DELETE FROM knowledge_chunks WHERE structure_id = ?", (structure_id,))
+
+def index_knowledge_chunks(c, structure_id, content):
+    if not search_enabled:
+        return
+    remove_knowledge_chunks(c, structure_id)
+    for chunk_index, chunk in enumerate(chunk_text(content)):
+        c.execute("INSERT INTO knowledge_chunks (structure_id, chunk_index, content) VALUES (?, ?, ?)",
+                  (structure_id, chunk_index, chunk))
+        c.execute("INSERT INTO knowledge_chunk_index (rowid, content) VALUES (?, ?)", (c.lastrowid, chunk))
+
+def retrieve_knowledge_chunks(structure_ids, query_text, top_k=5, token_budget=None):
+    # Best bm25 matches for query_text among the given structures' chunks, kept
+    # within top_k and the token budget and returned in document order
+    terms = []
+    for term in re.findall(r'\w+', query_text.lower()):
+        if len(term) > 2 and term not in terms:
+            terms.append(term)
+    if not terms or not structure_ids:
+        return []
+    match = ' OR '.join(f'"{term}"' for term in terms[:64])
+
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT k.structure_id, k.chunk_index, k.content, bm25(knowledge_chunk_index) AS rank
+        FROM knowledge_chunk_index
+        JOIN knowledge_chunks k ON k.id = knowledge_chunk_index.rowid
+        WHERE knowledge_chunk_index MATCH ? AND k.structure_id IN ({", ".join("?" * len(structure_ids))})
+        ORDER BY rank
+        LIMIT ?
+    """, (match, *structure_ids, top_k * 4))
+    candidates = [{"structure_id": row[0], "chunk_index": row[1], "content": row[2], "score": -row[3]} for row in c.fetchall()]
+    conn.close()
+    return select_chunks(candidates, top_k, token_budget, structure_ids)
+
+def select_chunks(candidates, top_k, token_budget, structure_ids):
+    # Take best-first candidates until top_k or the token budget is reached, then
+    # return them in document order: by the structure's place in structure_ids
+    # (each parent before its children, as in full_content), then within it
+    selected = []
+    used_tokens = 0
+    for chunk in candidates:
+        tokens = estimate_tokens(chunk['content'])
+        if token_budget is not None and used_tokens + tokens > token_budget:
+            continue
+        used_tokens += tokens
+        selected.append(chunk)
+        if len(selected) == top_k:
+            break
+    position = {structure_id: i for i, structure_id in enumerate(structure_ids)}
+    return sorted(selected, key=lambda chunk: (position[chunk['structure_id']], chunk['chunk_index']))
+
+# Semantic retrieval: chunk embeddings come from Ollama (or the deterministic
+# 'local-hash' stand-in), are cached in SQLite by content hash and model, and are
+# searched with an in-process cosine index
+OLLAMA_URL = os.environ.get('OSUI_OLLAMA_URL', 'http://localhost:11434')
+EMBEDDING_MODEL = os.environ.get('OSUI_EMBEDDING_MODEL', 'nomic-embed-text')
+LOCAL_EMBEDDING_DIMENSIONS = 256
+
+def local_hash_embedding(text):
+    vector = [0.0] * LOCAL_EMBEDDING_DIMENSIONS
+    for token in re.findall(r'\w+', text.lower()):
+        digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], 'little') % LOCAL_EMBEDDING_DIMENSIONS
+        vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+    return vector
+
+def ollama_embedding(text, model):
+    request = urllib.request.Request(
+        f"{OLLAMA_URL}/api/embeddings",
+        data=json.dumps({"model": model, "prompt": text}).encode(),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.loads(response.read())['embedding']
+
+def compute_embedding(text, model):
+    if model == 'local-hash':
+        return local_hash_embedding(text)
+    return ollama_embedding(text, model)
+
+class VectorIndex:
+    def __init__(self):
+        self.keys = []
+        self.rows = {}
+        self.vectors = []
+        self.matrix = None
+        self.lock = threading.Lock()
+
+    def add(self, key, vector):
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        with self.lock:
+            if key in self.rows:
+                return
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+            self.vectors.append([v / norm for v in vector])
+            self.matrix = None
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def retain(self, keys):
+        # Drops the vectors whose keys are not in keys
+        with self.lock:
+            kept = [row for row, key in enumerate(self.keys) if key in keys]
+            if len(kept) == len(self.keys):
+                return
+            self.keys = [self.keys[row] for row in kept]
+            self.vectors = [self.vectors[row] for row in kept]
+            self.rows = {key: row for row, key in enumerate(self.keys)}
+            self.matrix = None
+
+    def search(self, vector, k, keys=None):
+        # Top-k cosine similarity, optionally restricted to the given keys
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        with self.lock:
+            rows = [self.rows[key] for key in (self.keys if keys is None else keys) if key in self.rows]
+            if not rows:
+                return []
+            if np is not None:
+                if self.matrix is None:
+                    self.matrix = np.array(self.vectors, dtype=np.float32)
+                scores = self.matrix[rows] @ (np.array(vector, dtype=np.float32) / norm)
+                best = np.argsort(-scores)[:k]
+                return [(self.keys[rows[i]], float(scores[i])) for i in best]
+            query = [v / norm for v in vector]
+            scored = [(self.keys[row], sum(a * b for a, b in zip(self.vectors[row], query))) for row in rows]
+        return sorted(scored, key=lambda item: -item[1])[:k]
+
+vector_indexes = {}
+vector_indexes_lock = threading.Lock()
+
+def get_vector_index(model):
+    with vector_indexes_lock:
+        return vector_indexes.setdefault(model, VectorIndex())
+
+def prune_vector_indexes():
+    # Called after knowledge structures change, so vectors of chunks that were
+    # edited away or deleted don't stay in memory
+    with vector_indexes_lock:
+        indexes = list(vector_indexes.values())
+    if not any(index.keys for index in indexes):
+        return
+    conn = sqlite3.connect('ollama_workflows.db')
+    live = {content_hash(row[0]) for row in conn.execute("SELECT content FROM knowledge_chunks")}
+    conn.close()
+    for index in indexes:
+        index.retain(live)
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def ensure_embeddings(contents_by_hash, model):
+    # Embeds each chunk at most once per model: memory first, then the SQLite
+    # cache, and only then the embedding model. A computed vector is committed
+    # before it enters the index, so the index never holds one that is not cached
+    index = get_vector_index(model)
+    missing = [h for h in contents_by_hash if h not in index]
+    if not missing:
+        return index
+
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    try:
+        for start in range(0, len(missing), 500):
+            batch = missing[start:start + 500]
+            c.execute(f"SELECT content_hash, vector FROM embeddings WHERE model = ? AND content_hash IN ({', '.join('?' * len(batch))})",
+                      (model, *batch))
+            for hash_, blob in c.fetchall():
+                vector = array('f')
+                vector.frombytes(blob)
+                index.add(hash_, vector.tolist())
+
+        for hash_ in missing:
+            if hash_ not in index:
+                vector = compute_embedding(contents_by_hash[hash_], model)
+                c.execute("INSERT OR REPLACE INTO embeddings (content_hash, model, dimensions, vector) VALUES (?, ?, ?, ?)",
+                          (hash_, model, len(vector), array('f', vector).tobytes()))
+                conn.commit()
+                index.add(hash_, vector)
+    finally:
+        conn.close()
+    return index
+
+def retrieve_semantic_chunks(structure_ids, query_text, top_k=5, token_budget=None, model=EMBEDDING_MODEL):
+    if not structure_ids or not query_text.strip():
+        return []
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute(f"SELECT structure_id, chunk_index, content FROM knowledge_chunks WHERE structure_id IN ({', '.join('?' * len(structure_ids))})",
+              structure_ids)
+    chunks_by_hash = {}
+    for structure_id, chunk_index, content in c.fetchall():
+        chunks_by_hash.setdefault(content_hash(content), {"structure_id": structure_id, "chunk_index": chunk_index, "content": content})
+    conn.close()
+    if not chunks_by_hash:
+        return []
+
+    index = ensure_embeddings({h: chunk['content'] for h, chunk in chunks_by_hash.items()}, model)
+    matches = index.search(compute_embedding(query_text, model), top_k * 4, list(chunks_by_hash))
+    candidates = [{**chunks_by_hash[h], "score": score} for h, score in matches]
+    return select_chunks(candidates, top_k, token_budget, structure_ids)
+
 def save_knowledge_structure(structure):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
     if 'id' not in structure or not structure['id']:
         structure['id'] = str(uuid.uuid4())
-    c.execute("INSERT OR REPLACE INTO knowledge_structures (id, name, content, parent_id) VALUES (?, ?, ?, ?)",
-              (structure['id'], structure['name'], structure['content'], structure.get('parent_id')))
-    conn.commit()
-    conn.close()
 
-def get_user_shortcuts():
     try:
-        result = subprocess.run(['shortcuts', 'list'], capture_output=True, text=True)
-        shortcuts = result.stdout.strip().split('\n')
-        return [{"id": str(uuid.uuid4()), "name": s, "description": "User shortcut"} for s in shortcuts if s]
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Error retrieving shortcuts: {str(e)}")
-        return []
+        c.execute("SELECT parent_id FROM knowledge_structures WHERE id = ?", (structure['id'],))
+        row = c.fetchone()
+        previous_parent_id = row[0] if row else None
+
+        c.execute("INSERT OR REPLACE INTO knowledge_structures (id, name, content, parent_id) VALUES (?, ?, ?, ?)",
+                  (structure['id'], structure['name'], structure['content'], structure.get('parent_id')))
+        for structure_id in {structure['id'], structure.get('parent_id'), previous_parent_id}:
+            if structure_id:
+                update_full_content(c, structure_id)
+        index_search_document(c, 'knowledge_structure', structure['id'], structure['name'], structure['content'])
+        index_knowledge_chunks(c, structure['id'], structure['content'])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    bump_table_version('knowledge_structures')
+    prune_vector_indexes()
 
-def refresh_shortcuts():
+def delete_knowledge_structure(structure_id):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("DELETE FROM shortcuts")
-    conn.commit()
-    
+
+    try:
+        c.execute("SELECT parent_id FROM knowledge_structures WHERE id = ?", (structure_id,))
+        row = c.fetchone()
+        c.execute("DELETE FROM knowledge_structures WHERE id = ?", (structure_id,))
+        if row and row[0]:
+            update_full_content(c, row[0])
+        remove_search_document(c, 'knowledge_structure', structure_id)
+        remove_knowledge_chunks(c, structure_id)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    bump_table_version('knowledge_structures')
+    prune_vector_indexes()
+
+def get_user_shortcuts():
+    # Raises when the CLI fails, so a failed listing is not taken for an empty one
+    result = subprocess.run([*SHORTCUTS_COMMAND, 'list'], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"shortcuts list failed: {result.stderr.strip() or f'exit status {result.returncode}'}")
+    shortcuts = result.stdout.strip().split('\n')
+    return [{"id": str(uuid.uuid4()), "name": s, "description": "User shortcut"} for s in shortcuts if s]
+
+def refresh_shortcuts():
     user_shortcuts = get_user_shortcuts()
-    for shortcut in user_shortcuts:
-        save_shortcut(shortcut)
-    
-    conn.close()
-    return user_shortcuts
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+
+    try:
+        # Diff against the stored set so existing rows keep their descriptions
+        c.execute("SELECT name, description FROM shortcuts")
+        stored = dict(c.fetchall())
+        current = {}
+        for shortcut in user_shortcuts:
+            current.setdefault(shortcut['name'], shortcut)
+        added = [(s['id'], s['name'], s['description']) for name, s in current.items() if name not in stored]
+        removed = [(name,) for name in stored if name not in current]
+
+        c.executemany("INSERT INTO shortcuts (id, name, description) VALUES (?, ?, ?)", added)
+        c.executemany("DELETE FROM shortcuts WHERE name = ?", removed)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+
+    if added or removed:
+        bump_table_version('shortcuts')
+    return [{"name": name, "description": stored.get(name, s['description'])} for name, s in current.items()]
 
 def update_shortcut_description(shortcut_name, description):
     conn = sqlite3.connect('ollama_workflows.db')
@@ -184,14 +1352,23 @@ def update_shortcut_description(shortcut_name, description):
     c.execute("UPDATE shortcuts SET description = ? WHERE name = ?", (description, shortcut_name))
     conn.commit()
     conn.close()
+    bump_table_version('shortcuts')
 
 def save_user_prompt(prompt):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO user_prompts (id, name, content) VALUES (?, ?, ?)",
-              (prompt['id'], prompt['name'], prompt['content']))
-    conn.commit()
-    conn.close()
+
+    try:
+        c.execute("INSERT OR REPLACE INTO user_prompts (id, name, content) VALUES (?, ?, ?)",
+                  (prompt['id'], prompt['name'], prompt['content']))
+        index_search_document(c, 'user_prompt', prompt['id'], prompt['name'], prompt['content'])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    bump_table_version('user_prompts')
 
 def get_user_prompts():
     conn = sqlite3.connect('ollama_workflows.db')
@@ -212,61 +1389,1120 @@ def get_user_prompt(prompt_id):
 def delete_user_prompt(prompt_id):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("DELETE FROM user_prompts WHERE id = ?", (prompt_id,))
-    conn.commit()
-    conn.close()
+
+    try:
+        c.execute("DELETE FROM user_prompts WHERE id = ?", (prompt_id,))
+        remove_search_document(c, 'user_prompt', prompt_id)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    bump_table_version('user_prompts')
 
 def delete_workflow(workflow_id):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
-    c.execute("DELETE FROM workflows WHERE id = ?", (workflow_id,))
-    conn.commit()
-    conn.close()
 
-def get_ollama_models():
     try:
-        result = subprocess.run(['ollama', 'list'], capture_output=True, text=True)
-        if result.returncode == 0:
-            models = result.stdout.strip().split('\n')
-            return [model.split()[0] for model in models if model]
-        else:
-            logging.error(f"Failed to fetch Ollama models: {result.stderr}")
-            return []
+        c.execute("DELETE FROM workflows WHERE id = ?", (workflow_id,))
+        c.execute("DELETE FROM workflow_steps WHERE workflow_id = ?", (workflow_id,))
+        remove_search_document(c, 'workflow', workflow_id)
+        conn.commit()
     except Exception as e:
-        logging.error(f"Error fetching Ollama models: {str(e)}")
-        return []
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    bump_table_version('workflows')
+
+def get_ollama_models():
+    # Errors are raised so the discovery cache can report them
+    result = subprocess.run([*OLLAMA_COMMAND, 'list'], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"ollama list failed: {result.stderr.strip() or f'exit status {result.returncode}'}")
+    models = result.stdout.strip().split('\n')
+    return [model.split()[0] for model in models if model]
+
+# Model and shortcut discovery shell out to slow CLIs, so their results are cached
+# and refreshed on a background thread instead of inside request handlers
+DISCOVERY_TTL = float(os.environ.get('OSUI_DISCOVERY_TTL', 300))
+
+class DiscoveryCache:
+    def __init__(self, name, loader, ttl=DISCOVERY_TTL):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.value = []
+        self.updated_at = None
+        self.checked_at = None
+        self.error = None
+        self.refreshing = False
+        # Bumped whenever the reported state changes, for ETags
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        # Never blocks: returns the cached value and kicks off a refresh when stale
+        with self.lock:
+            if self.checked_at is None or time.time() - self.checked_at > self.ttl:
+                self._start_refresh()
+            return {self.name: self.value, **self._status()}
+
+    def status(self):
+        # Only reports; polling the status never starts a refresh
+        with self.lock:
+            return {'count': len(self.value), **self._status()}
+
+    def _status(self):
+        return {
+            'age': round(time.time() - self.updated_at, 3) if self.updated_at else None,
+            'refreshing': self.refreshing,
+            'error': self.error
+        }
+
+    def refresh_async(self):
+        with self.lock:
+            self._start_refresh()
+
+    def _start_refresh(self):
+        # Concurrent callers join the refresh already in flight
+        if not self.refreshing:
+            self.refreshing = True
+            self.version += 1
+            threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        try:
+            value = self.loader()
+            error = None
+        except Exception as e:
+            logging.error(f"Error refreshing {self.name}: {str(e)}")
+            value = None
+            error = str(e)
+        with self.lock:
+            if value is not None:
+                self.value = value
+                self.updated_at = time.time()
+            self.checked_at = time.time()
+            self.error = error
+            self.refreshing = False
+            self.version += 1
+
+ollama_model_discovery = DiscoveryCache('models', get_ollama_models)
+shortcut_discovery = DiscoveryCache('shortcuts', refresh_shortcuts)
 
 # Initialize shortcuts on startup
 def init_shortcuts():
+    ollama_model_discovery.refresh_async()
     if not get_shortcuts():
-        refresh_shortcuts()
+        shortcut_discovery.refresh_async()
 
 # Workflow and Shortcut execution
-async def run_shortcut(shortcut_name, input_json):
-    with tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_file:
-        json.dump(input_json, temp_file)
+# Shortcut runs share a fixed number of slots (Shortcuts and Ollama have limited
+# capacity). Runs from the UI are 'interactive' and always go first; 'batch' runs
+# (/api/run-workflow) may only use the slots not reserved for interactive work,
+# and are shared between API clients by weight (stride scheduling). The class
+# and client of the current run travel in run_priority.
+MAX_CONCURRENT_SHORTCUTS = int(os.environ.get('OSUI_MAX_CONCURRENT_SHORTCUTS', 4))
+INTERACTIVE_RESERVED_SLOTS = int(os.environ.get('OSUI_INTERACTIVE_RESERVED_SLOTS', 1))
+CLIENT_WEIGHTS = json.loads(os.environ.get('OSUI_CLIENT_WEIGHTS', '{}'))
+INTERACTIVE, BATCH = 'interactive', 'batch'
+
+run_priority = contextvars.ContextVar('run_priority', default=(INTERACTIVE, None))
+
+class ShortcutScheduler:
+    def __init__(self, slots, reserved):
+        self.slots = max(slots, 1)
+        self.batch_slots = max(self.slots - reserved, 1)
+        self.running = {INTERACTIVE: 0, BATCH: 0}
+        self.interactive_waiters = []
+        self.client_waiters = {}  # client -> FIFO list of batch waiters
+        self.client_pass = {}
+        self.virtual_time = 0.0
+        self.waited = {INTERACTIVE: [0, 0.0], BATCH: [0, 0.0]}  # count, total seconds
+        self.lock = threading.Lock()
+
+    async def acquire(self, priority, client):
+        # Waiters are (future, loop, priority, enqueued_at); each run has its own
+        # event loop, so grants are handed over with call_soon_threadsafe
+        loop = asyncio.get_running_loop()
+        waiter = (loop.create_future(), loop, priority, time.perf_counter())
+        with self.lock:
+            if priority == INTERACTIVE:
+                self.interactive_waiters.append(waiter)
+            else:
+                if client not in self.client_waiters:
+                    self.client_waiters[client] = []
+                    # A returning client starts at the current virtual time rather
+                    # than spending credit it banked while idle
+                    self.client_pass[client] = max(self.client_pass.get(client, 0.0), self.virtual_time)
+                self.client_waiters[client].append(waiter)
+            grants = self._grant()
+        self._deliver(grants)
+        try:
+            await waiter[0]
+        except asyncio.CancelledError:
+            if waiter[0].done() and not waiter[0].cancelled():  # granted, then cancelled
+                self.release(priority)
+            raise
+
+    def release(self, priority):
+        with self.lock:
+            self.running[priority] -= 1
+            grants = self._grant()
+        self._deliver(grants)
+
+    def _grant(self):
+        grants = []
+        while sum(self.running.values()) < self.slots:
+            if self.interactive_waiters:
+                waiter = self.interactive_waiters.pop(0)
+            elif self.client_waiters and self.running[BATCH] < self.batch_slots:
+                client = min(self.client_waiters, key=lambda c: self.client_pass[c])
+                waiter = self.client_waiters[client].pop(0)
+                if not self.client_waiters[client]:
+                    del self.client_waiters[client]
+                self.virtual_time = self.client_pass[client]
+                self.client_pass[client] += 1.0 / float(CLIENT_WEIGHTS.get(client, 1))
+            else:
+                break
+            self.running[waiter[2]] += 1
+            wait = time.perf_counter() - waiter[3]
+            self.waited[waiter[2]][0] += 1
+            self.waited[waiter[2]][1] += wait
+            scheduler_wait.observe((waiter[2],), wait)
+            grants.append(waiter)
+        return grants
+
+    def _deliver(self, grants):
+        for future, loop, priority, _ in grants:
+            try:
+                loop.call_soon_threadsafe(self._resolve, future, priority)
+            except RuntimeError:  # the run's loop has already closed
+                self.release(priority)
+
+    def _resolve(self, future, priority):
+        if future.done():  # cancelled while queued; pass the slot on
+            self.release(priority)
+        else:
+            future.set_result(None)
+
+    def status(self):
+        with self.lock:
+            queued = {INTERACTIVE: len(self.interactive_waiters),
+                      BATCH: sum(len(waiters) for waiters in self.client_waiters.values())}
+            return {
+                'slots': self.slots,
+                'batch_slots': self.batch_slots,
+                'classes': {priority: {'queued': queued[priority], 'running': self.running[priority],
+                                       'granted': self.waited[priority][0],
+                                       'mean_wait': self.waited[priority][1] / self.waited[priority][0]
+                                       if self.waited[priority][0] else 0.0}
+                            for priority in (INTERACTIVE, BATCH)},
+                'clients': {client: len(waiters) for client, waiters in self.client_waiters.items()},
+            }
+
+shortcut_scheduler = ShortcutScheduler(MAX_CONCURRENT_SHORTCUTS, INTERACTIVE_RESERVED_SLOTS)
+
+# Remote step workers ("agents"): `python webui.py agent` on another machine
+# registers the shortcuts and models it has, then pulls shortcut jobs over HTTP.
+# Agents and their jobs live in SQLite so every server worker sees them.
+# run_shortcut places each job on the least loaded live agent that can run it,
+# or on this machine when OSUI_LOCAL_SHORTCUTS allows and it is less loaded.
+AGENT_TOKEN = os.environ.get('OSUI_AGENT_TOKEN')
+AGENT_TIMEOUT = float(os.environ.get('OSUI_AGENT_TIMEOUT', 30))
+AGENT_HEARTBEAT_INTERVAL = AGENT_TIMEOUT / 3
+AGENT_POLL_SECONDS = 20
+AGENT_MAX_ATTEMPTS = 3
+LOCAL_SHORTCUTS = os.environ.get('OSUI_LOCAL_SHORTCUTS', '1') != '0'
+agent_jobs_available = threading.Condition()
+# Number of live agents, re-read at most every AGENT_COUNT_CACHE_SECONDS so a
+# server without agents runs shortcuts without a placement transaction
+AGENT_COUNT_CACHE_SECONDS = 2
+live_agent_cache = {'count': 0, 'checked_at': 0.0}
+live_agent_cache_lock = threading.Lock()
+
+def host_load():
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+def model_tag(model):
+    # Ollama treats a bare model name as its :latest tag
+    return model if ':' in model else f"{model}:latest"
+
+def model_available(model, models):
+    return not model or model_tag(model) in {model_tag(m) for m in models}
+
+def register_agent(name, shortcuts, models, slots, load):
+    agent_id = uuid.uuid4().hex
+    now = time.time()
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    try:
+        # Forget agents that have been gone for a while
+        c.execute("DELETE FROM agent_jobs WHERE agent_id IN (SELECT id FROM agents WHERE last_seen < ?)",
+                  (now - 10 * AGENT_TIMEOUT,))
+        c.execute("DELETE FROM agents WHERE last_seen < ?", (now - 10 * AGENT_TIMEOUT,))
+        c.execute('''INSERT INTO agents (id, name, shortcuts, models, slots, load, registered_at, last_seen)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                  (agent_id, name, json.dumps(shortcuts), json.dumps(models), slots, load, now, now))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    with live_agent_cache_lock:
+        live_agent_cache['checked_at'] = 0.0
+    logging.info(f"Agent {name} ({agent_id}) registered with {len(shortcuts)} shortcuts and {slots} slots")
+    return agent_id
+
+def live_agent_count():
+    now = time.time()
+    with live_agent_cache_lock:
+        if now - live_agent_cache['checked_at'] < AGENT_COUNT_CACHE_SECONDS:
+            return live_agent_cache['count']
+    conn = sqlite3.connect('ollama_workflows.db')
+    count = conn.execute("SELECT COUNT(*) FROM agents WHERE last_seen > ?", (now - AGENT_TIMEOUT,)).fetchone()[0]
+    conn.close()
+    with live_agent_cache_lock:
+        live_agent_cache.update(count=count, checked_at=now)
+    return count
+
+def touch_agent(agent_id, load=None):
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute("UPDATE agents SET last_seen = ?, load = COALESCE(?, load) WHERE id = ?", (time.time(), load, agent_id))
+    found = c.rowcount > 0
+    conn.commit()
+    conn.close()
+    return found
+
+def cancelled_agent_jobs(agent_id):
+    conn = sqlite3.connect('ollama_workflows.db')
+    job_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM agent_jobs WHERE agent_id = ? AND status = 'cancelled'", (agent_id,))]
+    conn.close()
+    return job_ids
+
+def list_agents():
+    now = time.time()
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute('''SELECT a.id, a.name, a.shortcuts, a.models, a.slots, a.load, a.last_seen,
+                        (SELECT COUNT(*) FROM agent_jobs j WHERE j.agent_id = a.id AND j.status = 'queued'),
+                        (SELECT COUNT(*) FROM agent_jobs j WHERE j.agent_id = a.id AND j.status = 'running')
+                 FROM agents a ORDER BY a.name''')
+    agents = [{'id': agent_id, 'name': name, 'shortcuts': json.loads(shortcuts), 'models': json.loads(models),
+               'slots': slots, 'load': load, 'queued': queued, 'running': running,
+               'last_seen': last_seen, 'live': last_seen > now - AGENT_TIMEOUT}
+              for agent_id, name, shortcuts, models, slots, load, last_seen, queued, running in c.fetchall()]
+    conn.close()
+    return agents
+
+def place_shortcut(shortcut_name, model, priority, payload, exclude=()):
+    # Picks where to run a shortcut by jobs per slot, then the host's load
+    # average per CPU. An agent's job is queued in the same transaction, so
+    # concurrent placements count each other's jobs. Returns (agent id, agent
+    # name, job id), or None to run locally.
+    if LOCAL_SHORTCUTS and not live_agent_count():
+        return None
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute('''SELECT a.id, a.name, a.shortcuts, a.models, a.slots, a.load,
+                            (SELECT COUNT(*) FROM agent_jobs j WHERE j.agent_id = a.id AND j.status IN ('queued', 'running'))
+                     FROM agents a WHERE a.last_seen > ?''', (time.time() - AGENT_TIMEOUT,))
+        candidates = [((active + 1) / max(slots, 1), load or 0.0, (agent_id, name))
+                      for agent_id, name, shortcuts, models, slots, load, active in c.fetchall()
+                      if agent_id not in exclude and shortcut_name in json.loads(shortcuts)
+                      and model_available(model, json.loads(models))]
+        if LOCAL_SHORTCUTS:
+            status = shortcut_scheduler.status()
+            busy = sum(data['queued'] + data['running'] for data in status['classes'].values())
+            candidates.append(((busy + 1) / status['slots'], host_load(), None))
+        if not candidates:
+            raise Exception(f"No worker agent can run shortcut {shortcut_name}" + (f" with model {model}" if model else ''))
+        agent = min(candidates, key=lambda candidate: candidate[:2])[2]
+        if agent is None:
+            conn.rollback()
+            return None
+        job_id = uuid.uuid4().hex
+        c.execute('''INSERT INTO agent_jobs (id, agent_id, shortcut_name, model, priority, payload, status, created_at)
+                     VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)''',
+                  (job_id, agent[0], shortcut_name, model, priority, payload, time.time()))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    with agent_jobs_available:
+        agent_jobs_available.notify_all()
+    return (*agent, job_id)
+
+def claim_agent_job(agent_id):
+    # Interactive jobs go first, then oldest first
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    try:
+        while True:
+            c.execute('''SELECT id, shortcut_name, payload FROM agent_jobs WHERE agent_id = ? AND status = 'queued'
+                         ORDER BY priority = ?, created_at LIMIT 1''', (agent_id, BATCH))
+            row = c.fetchone()
+            if not row:
+                return None
+            c.execute("UPDATE agent_jobs SET status = 'running', claimed_at = ? WHERE id = ? AND status = 'queued'",
+                      (time.time(), row[0]))
+            conn.commit()
+            if c.rowcount:
+                return {'id': row[0], 'shortcut_name': row[1], 'payload': row[2]}
+    finally:
+        conn.close()
+
+def complete_agent_job(agent_id, job_id, output, error):
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute("DELETE FROM agent_jobs WHERE id = ? AND agent_id = ? AND status = 'cancelled'", (job_id, agent_id))
+    c.execute('''UPDATE agent_jobs SET status = ?, output = ?, error = ?, finished_at = ?
+                 WHERE id = ? AND status = 'running' AND agent_id = ?''',
+              ('error' if error is not None else 'completed', output, error, time.time(), job_id, agent_id))
+    conn.commit()
+    conn.close()
+
+def get_agent_job(job_id):
+    conn = sqlite3.connect('ollama_workflows.db')
+    row = conn.execute('''SELECT j.status, j.output, j.error, j.created_at, j.claimed_at, j.finished_at, a.last_seen
+                          FROM agent_jobs j LEFT JOIN agents a ON a.id = j.agent_id WHERE j.id = ?''',
+                       (job_id,)).fetchone()
+    conn.close()
+    return dict(zip(('status', 'output', 'error', 'created_at', 'claimed_at', 'finished_at', 'last_seen'), row)) if row else None
+
+def cancel_agent_job(job_id):
+    # A queued job is dropped; a running one is killed by its agent on the next heartbeat
+    conn = sqlite3.connect('ollama_workflows.db')
+    conn.execute("DELETE FROM agent_jobs WHERE id = ? AND status IN ('queued', 'completed', 'error')", (job_id,))
+    conn.execute("UPDATE agent_jobs SET status = 'cancelled' WHERE id = ? AND status = 'running'", (job_id,))
+    conn.commit()
+    conn.close()
+
+async def run_agent_shortcut(placement, shortcut_name, payload, label_values, stats, span, placed_at):
+    # Returns the output, or None when the agent stopped answering before finishing
+    agent_id, agent_name, job_id = placement
+    agent_span = span_child(span, shortcut_name, 'agent', input_bytes=len(payload), agent=agent_name)
+    interval = 0.01
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, 0.1)
+            job = await asyncio.to_thread(get_agent_job, job_id)
+            if job and job['status'] in ('completed', 'error'):
+                break
+            if not job or not job['last_seen'] or job['last_seen'] < time.time() - AGENT_TIMEOUT:
+                logging.warning(f"Agent {agent_name} stopped responding; placing shortcut {shortcut_name} again")
+                span_finish(agent_span, 'error', error='agent lost')
+                return None
+    except asyncio.CancelledError:
+        span_finish(agent_span, 'cancelled')
+        raise
+    finally:
+        await asyncio.to_thread(cancel_agent_job, job_id)
+    waited = (placed_at - stats.get('queued_at', placed_at)) + (job['claimed_at'] - job['created_at'])
+    shortcut_queue_wait.observe(label_values, waited)
+    execution = job['finished_at'] - job['claimed_at']
+    if job['status'] == 'error':
+        shortcut_failures.observe(label_values, execution)
+        span_finish(agent_span, 'error')
+        raise Exception(f"Shortcut {shortcut_name} failed on agent {agent_name}: {job['error']}")
+    output_bytes = len(job['output'].encode())
+    shortcut_execution.observe(label_values, execution)
+    shortcut_output_size.observe(label_values, output_bytes)
+    stats['output_bytes'] = output_bytes
+    span_finish(agent_span, output_bytes=output_bytes)
+    return job['output']
+
+async def run_shortcut(shortcut_name, input_json, stats=None, labels=None, span=None):
+    # stats may carry 'queued_at' (a perf_counter time) for the queue wait metric;
+    # labels are the workflow, step and model ids to record the timings under.
+    # With a trace span, the process gets a child span.
+    stats = stats if stats is not None else {}
+    payload = json.dumps(input_json).encode()
+    stats['payload_bytes'] = len(payload)
+    label_values = (labels.get('workflow'), labels.get('step'), shortcut_name, labels.get('model')) \
+        if labels else ('', '', shortcut_name, '')
+
+    priority, client = run_priority.get()
+    model = input_json.get('model')
+    lost_agents = []
+    while True:
+        placed_at = time.perf_counter()
+        placement = await asyncio.to_thread(place_shortcut, shortcut_name, model, priority, payload.decode(), lost_agents)
+        if placement is None:
+            break
+        output = await run_agent_shortcut(placement, shortcut_name, payload, label_values, stats, span, placed_at)
+        if output is not None:
+            return output
+        lost_agents.append(placement[0])
+        if len(lost_agents) >= AGENT_MAX_ATTEMPTS:
+            raise Exception(f"Shortcut {shortcut_name} was lost by {len(lost_agents)} agents")
+
+    with tempfile.NamedTemporaryFile(mode='wb', delete=False) as temp_file:
+        temp_file.write(payload)
         temp_file_path = temp_file.name
 
+    try:
+        await shortcut_scheduler.acquire(priority, client)
+    except BaseException:
+        os.unlink(temp_file_path)
+        raise
+    spawn_start = time.perf_counter()
+    shortcut_queue_wait.observe(label_values, spawn_start - stats.get('queued_at', spawn_start))
+    process_span = span_child(span, shortcut_name, 'subprocess', input_bytes=len(payload))
     try:
         process = await asyncio.create_subprocess_exec(
-            'shortcuts', 'run', shortcut_name, '--input-path', temp_file_path,
+            *SHORTCUTS_COMMAND, 'run', shortcut_name, '--input-path', temp_file_path,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
-        stdout, stderr = await process.communicate()
+        spawned = time.perf_counter()
+        shortcut_spawn.observe(label_values, spawned - spawn_start)
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            span_finish(process_span, 'cancelled')
+            raise
+        shortcut_execution.observe(label_values, time.perf_counter() - spawned)
+        shortcut_output_size.observe(label_values, len(stdout))
+        stats['output_bytes'] = len(stdout)
+        logging.debug(f"Shortcut {shortcut_name} exited with {process.returncode} after "
+                      f"{time.perf_counter() - spawned:.3f}s with {len(stdout)} bytes of output")
         if process.returncode != 0:
             raise Exception(f"Shortcut {shortcut_name} failed: {stderr.decode()}")
+        span_finish(process_span, output_bytes=len(stdout))
         return stdout.decode()
+    except Exception:
+        shortcut_failures.observe(label_values, time.perf_counter() - spawn_start)
+        span_finish(process_span, 'error')
+        raise
     finally:
+        shortcut_scheduler.release(priority)
         os.unlink(temp_file_path)
+
+def step_knowledge_structures(step, structures_by_id, query_text=''):
+    # Each step only carries the structures it references, not the whole knowledge base
+    referenced = {
+        str(ks_id): structures_by_id.get(str(ks_id))
+        for ks_id in step.get('knowledgeStructures', [])
+    }
+    retrieval = step.get('retrieval') or {}
+    if retrieval.get('mode') not in ('bm25', 'semantic'):
+        return referenced
+    if not search_enabled:
+        # Chunks are only stored alongside the FTS5 search index
+        logging.warning(f"Retrieval mode {retrieval['mode']} needs the search index, which is off without FTS5; "
+                        f"step {step.get('id')} gets the full knowledge structures")
+        return referenced
+
+    # Retrieval mode swaps each structure's full text for its chunks (and its
+    # children's) that best match the step's prompt and input
+    scope = {}
+    for ks_id, structure in referenced.items():
+        if structure:
+            scope[str(structure['id'])] = ks_id
+            for child in structure.get('children', []):
+                scope[str(child['id'])] = ks_id
+    token_budget = int(retrieval['token_budget']) if retrieval.get('token_budget') is not None else None
+    if retrieval['mode'] == 'semantic':
+        chunks = retrieve_semantic_chunks(list(scope), query_text, int(retrieval.get('top_k', 5)),
+                                          token_budget, retrieval.get('model', EMBEDDING_MODEL))
+    else:
+        chunks = retrieve_knowledge_chunks(list(scope), query_text,
+                                           int(retrieval.get('top_k', 5)), token_budget)
+    retrieved = {}
+    for chunk in chunks:
+        retrieved.setdefault(scope[chunk['structure_id']], []).append(chunk['content'])
+
+    step_structures = {}
+    for ks_id, structure in referenced.items():
+        if structure is None:
+            step_structures[ks_id] = None
+            continue
+        full_content = "\n\n".join(retrieved.get(ks_id, []))
+        step_structures[ks_id] = {
+            "id": structure['id'],
+            "name": structure['name'],
+            "parent_id": structure['parent_id'],
+            "full_content": full_content,
+            "full_content_size": len(full_content.encode('utf-8')),
+            "retrieved_chunks": len(retrieved.get(ks_id, []))
+        }
+    return step_structures
         
-async def run_workflow(workflow, input_json, status_queue):
+# Context budgeting: each step's input is measured against its model's context
+# window (minus a reserve for the response) and trimmed field by field
+DEFAULT_CONTEXT_TOKENS = int(os.environ.get('OSUI_CONTEXT_TOKENS', 8192))
+MODEL_CONTEXT_TOKENS = json.loads(os.environ.get('OSUI_MODEL_CONTEXT_TOKENS', '{}'))
+RESPONSE_RESERVE_TOKENS = int(os.environ.get('OSUI_RESPONSE_RESERVE_TOKENS', 1024))
+DEFAULT_CONTEXT_POLICY = {
+    'strategy': os.environ.get('OSUI_TRIM_STRATEGY', 'middle'),
+    'order': ['knowledge_structures', 'branch_outputs', 'previous_output', 'user_input']
+}
+TRIM_MARKER = "\n\n[...]\n\n"
+
+def model_context_tokens(model):
+    if model in MODEL_CONTEXT_TOKENS:
+        return MODEL_CONTEXT_TOKENS[model]
+    return MODEL_CONTEXT_TOKENS.get((model or '').split(':')[0], DEFAULT_CONTEXT_TOKENS)
+
+def is_sized_structure(value):
+    return isinstance(value, dict) and isinstance(value.get('full_content_size'), int)
+
+def structure_tokens(structure):
+    # Counted from the stored full_content_size instead of serializing the text
+    # again; content and children, when present, repeat full_content
+    fields = {k: v for k, v in structure.items() if k not in ('content', 'children', 'full_content')}
+    children = [{k: v for k, v in child.items() if k != 'content'} for child in structure.get('children') or []]
+    text_bytes = structure['full_content_size'] * (2 if 'content' in structure else 1)
+    return estimate_tokens(json.dumps(fields)) + (estimate_tokens(json.dumps(children)) if children else 0) + (text_bytes + 3) // 4
+
+def measure_tokens(value):
+    if isinstance(value, str):
+        return estimate_tokens(value)
+    if is_sized_structure(value):
+        return structure_tokens(value)
+    if isinstance(value, dict) and value and all(item is None or is_sized_structure(item) for item in value.values()):
+        # The knowledge_structures field
+        return sum(structure_tokens(item) if item else 1 for item in value.values())
+    return estimate_tokens(json.dumps(value))
+
+def trim_text(text, max_tokens, strategy):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(max_tokens, 0) * 4
+    if strategy == 'head':  # keep the beginning
+        return text[:max_chars]
+    if strategy == 'tail':  # keep the end
+        return text[len(text) - max_chars:] if max_chars else ''
+    if strategy == 'summarize':
+        # Extractive summary: the first sentence of each paragraph, in order
+        summary = ''
+        for paragraph in text.split('\n\n'):
+            sentence = re.split(r'(?<=[.!?])\s', paragraph.strip(), maxsplit=1)[0]
+            if sentence and len(summary) + len(sentence) + 2 <= max_chars:
+                summary = f"{summary}\n\n{sentence}" if summary else sentence
+        return summary or text[:max_chars]
+    # 'middle': keep both ends and drop the middle
+    if max_chars <= len(TRIM_MARKER):
+        return text[:max_chars]
+    half = (max_chars - len(TRIM_MARKER)) // 2
+    return text[:half] + TRIM_MARKER + text[len(text) - half:]
+
+def trim_field(value, max_tokens, strategy):
+    if isinstance(value, str):
+        return trim_text(value, max_tokens, strategy)
+    if isinstance(value, dict) and value:
+        # Structures carry content and children alongside full_content; drop the
+        # duplicates before cutting any text
+        value = {key: ({k: v for k, v in item.items() if k not in ('content', 'children')}
+                       if isinstance(item, dict) and 'full_content' in item else item)
+                 for key, item in value.items()}
+        total = measure_tokens(value)
+        if total <= max_tokens:
+            return value
+        # Cut each entry in proportion to its share of the field
+        trimmed = {}
+        for key, item in value.items():
+            share = max_tokens * measure_tokens(item) // max(total, 1)
+            if isinstance(item, str):
+                trimmed[key] = trim_text(item, share, strategy)
+            elif isinstance(item, dict) and isinstance(item.get('full_content'), str):
+                overhead = measure_tokens({**item, 'full_content': '', 'full_content_size': 0})
+                full_content = trim_text(item['full_content'], share - overhead, strategy)
+                trimmed[key] = {**item, 'full_content': full_content, 'full_content_size': len(full_content.encode('utf-8'))}
+            else:
+                trimmed[key] = item
+        return trimmed
+    return value
+
+def fit_to_context(payload, model, policy=None):
+    # Returns the (possibly trimmed) payload and a report of per-field token
+    # counts before and after trimming
+    policy = {**DEFAULT_CONTEXT_POLICY, **(policy or {})}
+    budget = int(policy.get('max_tokens') or model_context_tokens(model) - RESPONSE_RESERVE_TOKENS)
+    before = {field: measure_tokens(value) for field, value in payload.items()}
+    report = {'model': model, 'budget': budget, 'before': before, 'after': before, 'trimmed': []}
+    over = sum(before.values()) - budget
+    if over <= 0:
+        return payload, report
+
+    payload = dict(payload)
+    after = dict(before)
+    for field in policy['order']:
+        if over <= 0:
+            break
+        if field not in payload or not payload[field]:
+            continue
+        payload[field] = trim_field(payload[field], max(after[field] - over, 0), policy['strategy'])
+        tokens = measure_tokens(payload[field])
+        over -= after[field] - tokens
+        after[field] = tokens
+        report['trimmed'].append(field)
+    report['after'] = after
+    if over > 0:
+        logging.warning(f"Input for model {model} is still {over} tokens over its {budget} token budget after trimming")
+    return payload, report
+
+# Per-run execution traces: a tree of spans (run, step, branch, subprocess)
+# with start/end offsets in microseconds from the run's start and input/output
+# byte counts. Spans on the same lane run sequentially; each branch of a branch
+# step gets its own lane so the export shows them side by side.
+class RunTrace:
+    def __init__(self, run_id, workflow_id):
+        self.run_id = run_id
+        self.workflow_id = workflow_id
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.steps = []
+        self.input_bytes = 0
+        self.lock = threading.Lock()
+
+    def now(self):
+        return int((time.perf_counter() - self.origin) * 1_000_000)
+
+    def start(self, name, category, parent=None, lane=0, **args):
+        with self.lock:
+            record = {'id': len(self.spans) + 1, 'parent': parent.record['id'] if parent else None,
+                      'name': name, 'cat': category, 'lane': lane, 'start': self.now(), 'end': None,
+                      'status': None, 'args': args}
+            self.spans.append(record)
+        return Span(self, record)
+
+    def record_step(self, span, step_number, step, status, output):
+        with self.lock:
+            self.steps.append((step_number, step.get('id'), step.get('name'), status,
+                               self.started_at + span.record['start'] / 1_000_000, time.time(), output))
+
+    def close_open_spans(self, status):
+        end = self.now()
+        with self.lock:
+            for record in self.spans:
+                if record['end'] is None:
+                    record['end'] = end
+                    record['status'] = status
+
+class Span:
+    def __init__(self, trace, record):
+        self.trace = trace
+        self.record = record
+
+    def child(self, name, category, lane=None, **args):
+        return self.trace.start(name, category, self, self.record['lane'] if lane is None else lane, **args)
+
+    def finish(self, status='ok', **args):
+        end = self.trace.now()
+        with self.trace.lock:
+            self.record['end'] = end
+            self.record['status'] = status
+            self.record['args'].update(args)
+
+def span_child(span, name, category, lane=None, **args):
+    # Tracing is optional, so callers may hold no span
+    return span.child(name, category, lane, **args) if span else None
+
+def span_finish(span, status='ok', **args):
+    if span:
+        span.finish(status, **args)
+
+def record_step(span, step_number, step, status, output):
+    # Keeps a step's output for the run history
+    if span:
+        span.trace.record_step(span, step_number, step, status, output)
+
+# Run history: each run's input, per-step outputs and status are written when
+# it finishes. Text of at least OSUI_RUN_COMPRESS_BYTES is stored zlib-compressed.
+# A background job deletes runs past the age or size limits.
+RUN_COMPRESS_BYTES = int(os.environ.get('OSUI_RUN_COMPRESS_BYTES', 1024))
+RUN_RETENTION_DAYS = float(os.environ.get('OSUI_RUN_RETENTION_DAYS', 30))
+RUN_HISTORY_MAX_MB = float(os.environ.get('OSUI_RUN_HISTORY_MAX_MB', 1024))
+RUN_COMPACTION_INTERVAL = float(os.environ.get('OSUI_RUN_COMPACTION_INTERVAL', 3600))
+
+def pack_text(text):
+    data = text.encode('utf-8')
+    if len(data) >= RUN_COMPRESS_BYTES:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return compressed, 'zlib'
+    return text, None
+
+def unpack_text(value, encoding):
+    if value is None:
+        return None
+    return zlib.decompress(value).decode('utf-8') if encoding == 'zlib' else value
+
+def stored_size(value):
+    return len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+
+def start_run(trace, input_json):
+    packed_input, input_encoding = pack_text(json.dumps(input_json))
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute('''INSERT INTO workflow_runs (id, workflow_id, status, started_at, input, input_encoding, worker)
+                 VALUES (?, ?, 'running', ?, ?, ?, ?)''',
+              (trace.run_id, trace.workflow_id, trace.started_at, packed_input, input_encoding, os.getpid()))
+    conn.commit()
+    conn.close()
+    trace.input_bytes = stored_size(packed_input)
+
+def finish_run(trace, status, error=None, event=None):
+    # event is the run's final status event; it is stored with the status so
+    # an event stream never sees the run finished without it
+    trace.close_open_spans(status)
+    with trace.lock:
+        spans = json.dumps(trace.spans)
+        steps = list(trace.steps)
+    step_rows = []
+    stored_bytes = trace.input_bytes + len(spans)
+    for step_number, step_id, name, step_status, started_at, ended_at, output in steps:
+        packed_output, output_encoding = pack_text(output)
+        stored_bytes += stored_size(packed_output)
+        step_rows.append((trace.run_id, step_number, step_id, name, step_status, started_at, ended_at,
+                          packed_output, output_encoding, len(output)))
+
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    try:
+        c.execute('''UPDATE workflow_runs SET status = ?, ended_at = ?, trace = ?, error = ?, step_count = ?, stored_bytes = ?
+                     WHERE id = ?''',
+                  (status, time.time(), spans, error, len(step_rows), stored_bytes, trace.run_id))
+        if event and WORKERS > 1:
+            c.execute("INSERT INTO run_events (run_id, data) VALUES (?, ?)", (trace.run_id, event))
+        c.executemany('''INSERT INTO run_steps
+                         (run_id, step_number, step_id, name, status, started_at, ended_at, output, output_encoding, output_size)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', step_rows)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+
+def get_run(run_id):
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute("SELECT id, workflow_id, status, started_at, ended_at, trace FROM workflow_runs WHERE id = ?", (run_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return None
+    return {"id": row[0], "workflow_id": row[1], "status": row[2], "started_at": row[3], "ended_at": row[4],
+            "trace": json.loads(row[5]) if row[5] else []}
+
+# Status events of each run, so it can be streamed (GET /runs/<id>/events) by
+# clients other than the one that started it. A single server process keeps
+# them in memory; pre-forked workers store them in run_events so any worker can
+# stream them and cancel the run (POST /runs/<id>/cancel). Step outputs are cut
+# to RUN_EVENT_OUTPUT_CHARS, the full outputs being in the run history, and a
+# run's events are dropped RUN_EVENT_RETENTION seconds after it finishes.
+RUN_EVENT_POLL_INTERVAL = 0.25
+RUN_CANCEL_POLL_INTERVAL = 0.5
+RUN_EVENT_OUTPUT_CHARS = 1000
+RUN_EVENT_RETENTION = 60
+TERMINAL_RUN_STATUSES = ('completed', 'error')
+run_event_logs = {}
+run_event_logs_lock = threading.Lock()
+# Runs executing in this process: run id -> [event loop, task, cancel requested]
+active_runs = {}
+active_runs_lock = threading.Lock()
+
+def run_event_record(event, data):
+    output = data.get('output')
+    if isinstance(output, str) and len(output) > RUN_EVENT_OUTPUT_CHARS:
+        return json.dumps({**data, 'output': output[:RUN_EVENT_OUTPUT_CHARS], 'output_size': len(output),
+                           'output_truncated': True})
+    return event
+
+def forget_run_events(run_id):
+    if WORKERS > 1:
+        conn = sqlite3.connect('ollama_workflows.db')
+        conn.execute("DELETE FROM run_events WHERE run_id = ?", (run_id,))
+        conn.commit()
+        conn.close()
+    else:
+        with run_event_logs_lock:
+            run_event_logs.pop(run_id, None)
+
+class RunEventQueue:
+    def __init__(self, run_id, status_queue):
+        self.run_id = run_id
+        self.status_queue = status_queue
+        if WORKERS <= 1:
+            with run_event_logs_lock:
+                run_event_logs[run_id] = []
+
+    def put(self, event):
+        data = json.loads(event)
+        if WORKERS <= 1:
+            with run_event_logs_lock:
+                run_event_logs[self.run_id].append(run_event_record(event, data))
+        elif data['status'] not in TERMINAL_RUN_STATUSES:
+            # Final events are stored by finish_run
+            conn = sqlite3.connect('ollama_workflows.db')
+            conn.execute("INSERT INTO run_events (run_id, data) VALUES (?, ?)",
+                         (self.run_id, run_event_record(event, data)))
+            conn.commit()
+            conn.close()
+        self.status_queue.put(event)
+
+    def close(self):
+        timer = threading.Timer(RUN_EVENT_RETENTION, forget_run_events, (self.run_id,))
+        timer.daemon = True
+        timer.start()
+
+def get_run_events(run_id, after=0):
+    # Returns the events after `after` and the run's (status, error, step_count) row
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    if WORKERS > 1:
+        c.execute("SELECT id, data FROM run_events WHERE run_id = ? AND id > ? ORDER BY id", (run_id, after))
+        events = c.fetchall()
+    else:
+        with run_event_logs_lock:
+            events = list(enumerate(run_event_logs.get(run_id, [])[after:], after + 1))
+    c.execute("SELECT status, error, step_count FROM workflow_runs WHERE id = ?", (run_id,))
+    run = c.fetchone()
+    conn.close()
+    return events, run
+
+def final_run_event(run_id, run):
+    # Stands in for the final event of a run that ended without one, e.g. when
+    # its worker died
+    status, error, step_count = run
+    if status == 'completed':
+        return json.dumps({"status": "completed", "total": step_count, "run_id": run_id})
+    return json.dumps({"status": "error", "message": error or f"Run {status}", "run_id": run_id})
+
+def request_run_cancel(run_id):
+    if WORKERS <= 1:
+        # Cancels the task directly; pre-forked workers poll for the flag instead
+        with active_runs_lock:
+            run = active_runs.get(run_id)
+            if not run:
+                return False
+            loop, task, requested = run
+            run[2] = True
+        if not requested:
+            loop.call_soon_threadsafe(task.cancel)
+        return True
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute("UPDATE workflow_runs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (run_id,))
+    updated = c.rowcount
+    conn.commit()
+    conn.close()
+    return updated > 0
+
+def run_cancel_requested(run_id):
+    conn = sqlite3.connect('ollama_workflows.db')
+    row = conn.execute("SELECT cancel_requested FROM workflow_runs WHERE id = ?", (run_id,)).fetchone()
+    conn.close()
+    return bool(row and row[0])
+
+async def run_cancellable(coroutine, run_id):
+    task = asyncio.ensure_future(coroutine)
+    with active_runs_lock:
+        active_runs[run_id] = [asyncio.get_running_loop(), task, False]
+    try:
+        cancelled = False
+        while WORKERS > 1 and not task.done():
+            done, _ = await asyncio.wait({task}, timeout=RUN_CANCEL_POLL_INTERVAL)
+            if not done and not cancelled and await asyncio.to_thread(run_cancel_requested, run_id):
+                task.cancel()
+                cancelled = True
+        return await task
+    finally:
+        with active_runs_lock:
+            active_runs.pop(run_id, None)
+
+def mark_worker_runs_interrupted(pid=None):
+    # Without a pid, every run still marked running: at startup none can be
+    conn = sqlite3.connect('ollama_workflows.db')
+    if pid is None:
+        c = conn.execute("UPDATE workflow_runs SET status = 'interrupted', ended_at = ? WHERE status = 'running'",
+                         (time.time(),))
+    else:
+        c = conn.execute("UPDATE workflow_runs SET status = 'interrupted', ended_at = ? WHERE worker = ? AND status = 'running'",
+                         (time.time(), pid))
+    conn.commit()
+    conn.close()
+    return c.rowcount
+
+def run_summary(row):
+    return {"id": row[0], "workflow_id": row[1], "status": row[2], "started_at": row[3], "ended_at": row[4],
+            "duration": row[4] - row[3] if row[4] else None, "step_count": row[5], "error": row[6]}
+
+def list_runs(workflow_id=None, status=None, limit=50, before=None):
+    # Newest first. `before` is the `next` cursor of the previous page, so each
+    # page is an index range scan instead of an OFFSET over skipped rows.
+    conditions, params = [], []
+    if workflow_id:
+        conditions.append("workflow_id = ?")
+        params.append(workflow_id)
+    if status:
+        conditions.append("status = ?")
+        params.append(status)
+    if before:
+        started_at, _, run_id = before.rpartition(':')
+        conditions.append("(started_at, id) < (?, ?)")
+        params += [float(started_at), run_id]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT id, workflow_id, status, started_at, ended_at, step_count, error
+        FROM workflow_runs {where}
+        ORDER BY started_at DESC, id DESC
+        LIMIT ?
+    """, params + [limit + 1])
+    rows = c.fetchall()
+    conn.close()
+    runs = [run_summary(row) for row in rows[:limit]]
+    next_cursor = f"{rows[limit - 1][3]!r}:{rows[limit - 1][0]}" if len(rows) > limit else None
+    return {"runs": runs, "next": next_cursor}
+
+def get_run_history(run_id):
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    c.execute("""SELECT id, workflow_id, status, started_at, ended_at, step_count, error, input, input_encoding
+                 FROM workflow_runs WHERE id = ?""", (run_id,))
+    row = c.fetchone()
+    if not row:
+        conn.close()
+        return None
+    run = run_summary(row)
+    run['input'] = json.loads(unpack_text(row[7], row[8])) if row[7] is not None else None
+    c.execute("""SELECT step_number, step_id, name, status, started_at, ended_at, output, output_encoding, output_size
+                 FROM run_steps WHERE run_id = ? ORDER BY step_number, id""", (run_id,))
+    run['steps'] = [{"step": r[0], "step_id": r[1], "name": r[2], "status": r[3], "started_at": r[4],
+                     "ended_at": r[5], "duration": r[5] - r[4], "output": unpack_text(r[6], r[7]), "output_size": r[8]}
+                    for r in c.fetchall()]
+    conn.close()
+    return run
+
+def delete_runs(c, run_ids):
+    placeholders = ','.join('?' * len(run_ids))
+    c.execute(f"DELETE FROM run_steps WHERE run_id IN ({placeholders})", run_ids)
+    c.execute(f"DELETE FROM run_events WHERE run_id IN ({placeholders})", run_ids)
+    c.execute(f"DELETE FROM workflow_runs WHERE id IN ({placeholders})", run_ids)
+
+def compact_run_history(batch_size=500):
+    # Deletes finished runs older than the retention period, then the oldest
+    # finished runs until the history fits its size limit. Works in batches so
+    # request threads are never locked out for long.
+    conn = sqlite3.connect('ollama_workflows.db')
+    c = conn.cursor()
+    deleted = 0
+    try:
+        if RUN_RETENTION_DAYS > 0:
+            cutoff = time.time() - RUN_RETENTION_DAYS * 86400
+            while True:
+                c.execute("""SELECT id FROM workflow_runs WHERE started_at < ? AND status != 'running'
+                             ORDER BY started_at LIMIT ?""", (cutoff, batch_size))
+                run_ids = [row[0] for row in c.fetchall()]
+                if not run_ids:
+                    break
+                delete_runs(c, run_ids)
+                conn.commit()
+                deleted += len(run_ids)
+
+        if RUN_HISTORY_MAX_MB > 0:
+            c.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM workflow_runs")
+            excess = c.fetchone()[0] - RUN_HISTORY_MAX_MB * 1024 * 1024
+            while excess > 0:
+                c.execute("""SELECT id, COALESCE(stored_bytes, 0) FROM workflow_runs WHERE status != 'running'
+                             ORDER BY started_at, id LIMIT ?""", (batch_size,))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                run_ids = []
+                for run_id, size in rows:
+                    if excess <= 0:
+                        break
+                    run_ids.append(run_id)
+                    excess -= size
+                delete_runs(c, run_ids)
+                conn.commit()
+                deleted += len(run_ids)
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        conn.close()
+    if deleted:
+        logging.info(f"Run history compaction deleted {deleted} runs")
+    return deleted
+
+def run_compaction_loop():
+    while True:
+        try:
+            compact_run_history()
+        except Exception as e:
+            logging.error(f"Error compacting run history: {str(e)}")
+        time.sleep(RUN_COMPACTION_INTERVAL)
+
+def start_run_compaction():
+    threading.Thread(target=run_compaction_loop, name='run-compaction', daemon=True).start()
+
+def branch_parallelism(spans):
+    # For each branch step: wall time, the summed time of its branches, and the
+    # branch on the critical path (the one that finished last)
+    children = {}
+    for span in spans:
+        children.setdefault(span['parent'], []).append(span)
+    summary = []
+    for span in spans:
+        branches = [child for child in children.get(span['id'], []) if child['cat'] == 'branch']
+        if span['cat'] != 'step' or not branches:
+            continue
+        wall = span['end'] - span['start']
+        busy = sum(branch['end'] - branch['start'] for branch in branches)
+        critical = max(branches, key=lambda branch: branch['end'])
+        summary.append({'step': span['name'], 'wall_ms': wall / 1000, 'busy_ms': busy / 1000,
+                        'parallelism': round(busy / wall, 2) if wall else None,
+                        'critical_branch': critical['name'],
+                        'critical_path': [child['name'] for child in children.get(critical['id'], [])]})
+    return summary
+
+def chrome_trace(run):
+    # Chrome trace-event format, for chrome://tracing or ui.perfetto.dev
+    origin = int(run['started_at'] * 1_000_000)
+    events = []
+    for lane in sorted({span['lane'] for span in run['trace']}):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane,
+                       'args': {'name': f"branch {lane}" if lane else 'workflow'}})
+    for span in run['trace']:
+        events.append({'name': span['name'], 'cat': span['cat'], 'ph': 'X', 'pid': 1, 'tid': span['lane'],
+                       'ts': origin + span['start'], 'dur': span['end'] - span['start'],
+                       'args': {**span['args'], 'status': span['status'], 'span_id': span['id'], 'parent_id': span['parent']}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'run_id': run['id'], 'workflow_id': run['workflow_id'], 'status': run['status'],
+                          'branches': branch_parallelism(run['trace'])}}
+
+def step_metric_labels(workflow_id, step, model):
+    return {'workflow': workflow_id, 'step': step.get('id', step.get('name')), 'model': model}
+
+async def run_workflow(workflow, input_json, status_queue, trace=None):
     output_context = {}
     branch_outputs = {}
+    run_span = trace.start(workflow['name'], 'run', input_bytes=len(json.dumps(input_json))) if trace else None
 
     # Fetch knowledge structures for the workflow
     knowledge_structures = get_workflow_knowledge_structures(workflow['id'])
-    input_json['knowledge_structures'] = knowledge_structures
+    structures_by_id = {str(ks['id']): ks for ks in knowledge_structures}
 
     def replace_merge_tags(text, context):
         for key, value in context.items():
@@ -288,14 +2524,16 @@ async def run_workflow(workflow, input_json, status_queue):
     for i, step in enumerate(workflow['steps']):
         if isinstance(step, dict) and step.get('type') == 'branch':
             status_queue.put(json.dumps({"status": "running", "step": current_step + 1, "total": total_steps, "message": f"Starting parallel branch with {len(step['branches'])} branches"}))
+            step_span = span_child(run_span, step.get('name', f"Branch step {i + 1}"), 'step')
 
             branch_tasks = []
             for branch_index, branch in enumerate(step['branches']):
                 branch_input = {**input_json, 'previous_output': output_context.get('previous_output', '')}
-                branch_tasks.append(run_branch(branch, branch_input, status_queue, current_step, total_steps, branch_index))
+                branch_tasks.append(run_branch(branch, branch_input, status_queue, current_step, total_steps, branch_index, structures_by_id, workflow['id'], step_span))
 
             branch_results = await asyncio.gather(*branch_tasks)
             branch_outputs[f"branch_{i}"] = {f"branch_{j}": result for j, result in enumerate(branch_results)}
+            span_finish(step_span, output_bytes=sum(len(result.encode()) for result in branch_results))
 
             current_step += sum(len(branch) for branch in step['branches'])
             status_queue.put(json.dumps({"status": "output", "step": current_step, "total": total_steps, "output": "Parallel branches completed"}))
@@ -303,87 +2541,120 @@ async def run_workflow(workflow, input_json, status_queue):
         elif isinstance(step, dict) and step.get('type') == 'merge':
             current_step += 1
             status_queue.put(json.dumps({"status": "running", "step": current_step, "total": total_steps, "message": "Executing merge step"}))
+            queued_at = time.perf_counter()
+            set_log_context(step_id=step.get('id'))
+            step_span = span_child(run_span, step.get('name', 'Merge step'), 'step')
 
+            # Retrieval may query SQLite or the embedding model, so keep it off the event loop
+            merge_structures = await asyncio.to_thread(
+                step_knowledge_structures, step, structures_by_id, output_context.get('previous_output', ''))
             merge_input = {
                 **input_json,
                 'previous_output': output_context.get('previous_output', ''),
-                'branch_outputs': branch_outputs[f"branch_{step['branchStepIndex']}"]
+                'branch_outputs': branch_outputs[f"branch_{step['branchStepIndex']}"],
+                'knowledge_structures': merge_structures
             }
+            merge_input, context_report = fit_to_context(
+                merge_input, step.get('model', input_json.get('model', '')), step.get('contextPolicy'))
             try:
-                output = await run_shortcut(step['shortcutName'], merge_input)
+                stats = {'queued_at': queued_at}
+                output = await run_shortcut(step['shortcutName'], merge_input, stats,
+                                            step_metric_labels(workflow['id'], step, step.get('model', input_json.get('model', ''))),
+                                            step_span)
                 output_context['previous_output'] = output
-                status_queue.put(json.dumps({"status": "output", "step": current_step, "total": total_steps, "output": output}))
+                span_finish(step_span, input_bytes=stats['payload_bytes'], output_bytes=stats['output_bytes'])
+                record_step(step_span, current_step, step, 'completed', output)
+                status_queue.put(json.dumps({"status": "output", "step": current_step, "total": total_steps, "output": output, "payload_bytes": stats['payload_bytes'], "context": context_report}))
             except Exception as e:
+                record_step(step_span, current_step, step, 'error', str(e))
                 status_queue.put(json.dumps({"status": "error", "step": current_step, "total": total_steps, "message": f"Error in merge step: {str(e)}"}))
                 raise
 
         else:
             current_step += 1
             status_queue.put(json.dumps({"status": "running", "step": current_step, "total": total_steps, "message": f"Executing step: {step.get('name', 'Unnamed Step')}"}))
+            queued_at = time.perf_counter()
+            set_log_context(step_id=step.get('id'))
+            step_span = span_child(run_span, step.get('name', 'Unnamed Step'), 'step')
 
             # Combine form inputs and previous outputs
             context = {**input_json, **output_context}
 
             # Replace merge tags in system prompt
-            if 'systemPrompt' in step:
-                step['systemPrompt'] = replace_merge_tags(step['systemPrompt'], context)
-
-            # Prepare step-specific knowledge structures
-            step_knowledge_structures = {
-                str(ks_id): next((ks for ks in knowledge_structures if str(ks['id']) == str(ks_id)), None)
-                for ks_id in step.get('knowledgeStructures', [])
-            }
+            system_prompt = replace_merge_tags(step.get('systemPrompt', ''), context)
 
+            user_input = output_context.get('previous_output', input_json.get('user_input', ''))
+            step_structures = await asyncio.to_thread(
+                step_knowledge_structures, step, structures_by_id, f"{system_prompt}\n{user_input}")
             input_for_step = {
                 **input_json,
-                'user_input': output_context.get('previous_output', input_json.get('user_input', '')),
+                'user_input': user_input,
                 'model': step.get('model', input_json.get('model', '')),
                 'shortcut_name': step['shortcutName'],
-                'system': step['systemPrompt'],
-                'knowledge_structures': step_knowledge_structures
+                'system': system_prompt,
+                'knowledge_structures': step_structures
             }
 
+            input_for_step, context_report = fit_to_context(input_for_step, input_for_step['model'], step.get('contextPolicy'))
             try:
-                output = await run_shortcut(step['shortcutName'], input_for_step)
+                stats = {'queued_at': queued_at}
+                output = await run_shortcut(step['shortcutName'], input_for_step, stats,
+                                            step_metric_labels(workflow['id'], step, input_for_step['model']),
+                                            step_span)
                 output_context['previous_output'] = output
-                status_queue.put(json.dumps({"status": "output", "step": current_step, "total": total_steps, "output": output}))
+                span_finish(step_span, input_bytes=stats['payload_bytes'], output_bytes=stats['output_bytes'])
+                record_step(step_span, current_step, step, 'completed', output)
+                status_queue.put(json.dumps({"status": "output", "step": current_step, "total": total_steps, "output": output, "payload_bytes": stats['payload_bytes'], "context": context_report}))
             except Exception as e:
+                record_step(step_span, current_step, step, 'error', str(e))
                 status_queue.put(json.dumps({"status": "error", "step": current_step, "total": total_steps, "message": f"Error in step {step.get('name', 'Unnamed Step')}: {str(e)}"}))
                 raise
 
-    status_queue.put(json.dumps({"status": "completed", "total": total_steps}))
+    span_finish(run_span, output_bytes=len(output_context.get('previous_output', '').encode()))
+    set_log_context(step_id=None)
+    logging.info(f"Completed run of {total_steps} steps")
+    completed = json.dumps({"status": "completed", "total": total_steps, "run_id": trace.run_id if trace else None})
+    if trace:
+        await asyncio.to_thread(finish_run, trace, 'completed', None, completed)
+    status_queue.put(completed)
 
 def get_workflow_knowledge_structures(workflow_id):
     conn = sqlite3.connect('ollama_workflows.db')
     c = conn.cursor()
     
     c.execute("""
-        SELECT DISTINCT ks.id, ks.name, ks.content, ks.parent_id
+        SELECT DISTINCT ks.id, ks.name, ks.content, ks.parent_id, ks.full_content, ks.full_content_size
         FROM knowledge_structures ks
         JOIN workflow_knowledge_structures wks ON ks.id = wks.structure_id
         WHERE wks.workflow_id = ?
     """, (workflow_id,))
-    structures = [{"id": row[0], "name": row[1], "content": row[2], "parent_id": row[3]} for row in c.fetchall()]
+    structures = [{"id": row[0], "name": row[1], "content": row[2], "parent_id": row[3],
+                   "full_content": row[4], "full_content_size": row[5]} for row in c.fetchall()]
     
-    # Fetch child structures for parent structures
+    # Fetch the children of every linked parent structure in one query;
+    # full_content itself is materialized by save_knowledge_structure
+    c.execute("""
+        SELECT child.id, child.name, child.content, child.parent_id
+        FROM workflow_knowledge_structures wks
+        JOIN knowledge_structures parent ON parent.id = wks.structure_id AND parent.parent_id IS NULL
+        JOIN knowledge_structures child ON child.parent_id = parent.id
+        WHERE wks.workflow_id = ?
+    """, (workflow_id,))
+    children_by_parent = {}
+    for row in c.fetchall():
+        children_by_parent.setdefault(row[3], []).append({"id": row[0], "name": row[1], "content": row[2]})
+
     for structure in structures:
         if structure['parent_id'] is None:  # This is a parent structure
-            c.execute("""
-                SELECT id, name, content
-                FROM knowledge_structures
-                WHERE parent_id = ?
-            """, (structure['id'],))
-            children = [{"id": row[0], "name": row[1], "content": row[2]} for row in c.fetchall()]
-            structure['children'] = children
-            structure['full_content'] = structure['content'] + "\n\n" + "\n\n".join([child['content'] for child in children])
-        else:
-            structure['full_content'] = structure['content']
+            structure['children'] = children_by_parent.get(structure['id'], [])
 
     conn.close()
     return structures
     
-async def run_branch(branch_steps, input_json, status_queue, start_step, total_steps, branch_index):
+async def run_branch(branch_steps, input_json, status_queue, start_step, total_steps, branch_index, structures_by_id, workflow_id=None, span=None):
     output_context = {}
+    branch_span = span_child(span, f"Branch {branch_index + 1}", 'branch', lane=branch_index + 1,
+                             input_bytes=len(json.dumps(input_json)))
     for i, step in enumerate(branch_steps):
         current_step = start_step + i + 1
         status_queue.put(json.dumps({
@@ -392,19 +2663,39 @@ async def run_branch(branch_steps, input_json, status_queue, start_step, total_s
             "total": total_steps, 
             "message": f"Executing branch {branch_index + 1}, step {i + 1}: {step.get('name', 'Unnamed Step')}"
         }))
-        
-        input_for_step = {**input_json, 'previous_output': output_context.get('previous_output', '')}
+        queued_at = time.perf_counter()
+        set_log_context(step_id=step.get('id'))
+        step_span = span_child(branch_span, step.get('name', f"Step {i + 1}"), 'step')
+
+        step_structures = await asyncio.to_thread(
+            step_knowledge_structures, step, structures_by_id,
+            f"{step.get('systemPrompt', '')}\n{output_context.get('previous_output', '')}")
+        input_for_step = {
+            **input_json,
+            'previous_output': output_context.get('previous_output', ''),
+            'knowledge_structures': step_structures
+        }
+        input_for_step, context_report = fit_to_context(
+            input_for_step, step.get('model', input_json.get('model', '')), step.get('contextPolicy'))
         try:
-            output = await run_shortcut(step['shortcutName'], input_for_step)
+            stats = {'queued_at': queued_at}
+            output = await run_shortcut(step['shortcutName'], input_for_step, stats,
+                                        step_metric_labels(workflow_id, step, step.get('model', input_json.get('model', ''))),
+                                        step_span)
             output_context['previous_output'] = output
+            span_finish(step_span, input_bytes=stats['payload_bytes'], output_bytes=stats['output_bytes'])
+            record_step(step_span, current_step, step, 'completed', output)
             status_queue.put(json.dumps({
                 "status": "output", 
                 "step": current_step, 
                 "total": total_steps, 
                 "output": output,
+                "payload_bytes": stats['payload_bytes'],
+                "context": context_report,
                 "message": f"Completed branch {branch_index + 1}, step {i + 1}"
             }))
         except Exception as e:
+            record_step(step_span, current_step, step, 'error', str(e))
             status_queue.put(json.dumps({
                 "status": "error", 
                 "step": current_step, 
@@ -412,136 +2703,89 @@ async def run_branch(branch_steps, input_json, status_queue, start_step, total_s
                 "message": f"Error in branch {branch_index + 1}, step {i + 1}: {str(e)}"
             }))
             raise
+    span_finish(branch_span, output_bytes=len(output_context['previous_output'].encode()))
     return output_context['previous_output']
 
-def workflow_runner(workflow, input_json, result_queue):
+# Admission control: at most OSUI_MAX_ACTIVE_RUNS workflow runs (each a thread,
+# queued or running) exist at once. Further run requests get a 429 with a
+# Retry-After estimated from recent run durations.
+MAX_ACTIVE_RUNS = int(os.environ.get('OSUI_MAX_ACTIVE_RUNS', 32))
+
+class RunAdmission:
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.mean_duration = None  # exponentially weighted, in seconds
+        self.lock = threading.Lock()
+
+    def admit(self):
+        with self.lock:
+            if self.active >= self.limit:
+                self.rejected += 1
+                return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self, duration):
+        with self.lock:
+            self.active -= 1
+            self.mean_duration = duration if self.mean_duration is None else 0.8 * self.mean_duration + 0.2 * duration
+
+    def retry_after(self):
+        # Roughly how long until one of the active runs finishes
+        with self.lock:
+            if self.mean_duration is None:
+                return 5
+            return min(max(math.ceil(self.mean_duration / max(self.active, 1)), 1), 60)
+
+    def status(self):
+        with self.lock:
+            return {'active': self.active, 'limit': self.limit, 'occupancy': self.active / self.limit if self.limit else 1.0,
+                    'admitted': self.admitted, 'rejected': self.rejected, 'mean_duration': self.mean_duration}
+
+run_admission = RunAdmission(MAX_ACTIVE_RUNS)
+
+def start_workflow_run(workflow, input_json, result_queue, priority=INTERACTIVE, client=None):
+    # Returns False, without starting anything, when the run is not admitted
+    if not run_admission.admit():
+        return False
+
+    def run():
+        start = time.perf_counter()
+        try:
+            workflow_runner(workflow, input_json, result_queue, priority, client)
+        finally:
+            run_admission.release(time.perf_counter() - start)
+
+    threading.Thread(target=run).start()
+    return True
+
+def workflow_runner(workflow, input_json, result_queue, priority=INTERACTIVE, client=None):
+    trace = RunTrace(uuid.uuid4().hex, workflow['id'])
+    set_log_context(run_id=trace.run_id, workflow_id=workflow['id'])
+    run_priority.set((priority, client))
+    events = RunEventQueue(trace.run_id, result_queue)
     try:
-        async def run_workflow_async():
-            output_context = {}
-            branch_outputs = {}
-
-            def count_total_steps(steps):
-                total = 0
-                for step in steps:
-                    if isinstance(step, dict) and step.get('type') == 'branch':
-                        total += sum(len(branch) for branch in step['branches'])
-                    else:
-                        total += 1
-                return total
-
-            def replace_merge_tags(text, context):
-                for key, value in context.items():
-                    text = text.replace(f"{{{{{key}}}}}", str(value))
-                return text
-
-            total_steps = count_total_steps(workflow['steps'])
-            current_step = 0
-
-            for i, step in enumerate(workflow['steps']):
-                if isinstance(step, dict) and step.get('type') == 'branch':
-                    result_queue.put(json.dumps({
-                        "status": "running", 
-                        "step": current_step + 1, 
-                        "total": total_steps, 
-                        "message": f"Starting parallel branch with {len(step['branches'])} branches"
-                    }))
-                    
-                    branch_tasks = []
-                    for branch_index, branch in enumerate(step['branches']):
-                        branch_input = {**input_json, 'previous_output': output_context.get('previous_output', '')}
-                        branch_tasks.append(run_branch(branch, branch_input, result_queue, current_step, total_steps, branch_index))
-                    
-                    branch_results = await asyncio.gather(*branch_tasks)
-                    branch_outputs[f"branch_{i}"] = {f"branch_{j}": result for j, result in enumerate(branch_results)}
-                    
-                    current_step += sum(len(branch) for branch in step['branches'])
-                    result_queue.put(json.dumps({
-                        "status": "output", 
-                        "step": current_step, 
-                        "total": total_steps, 
-                        "output": "Parallel branches completed"
-                    }))
-                
-                elif isinstance(step, dict) and step.get('type') == 'merge':
-                    current_step += 1
-                    result_queue.put(json.dumps({
-                        "status": "running", 
-                        "step": current_step, 
-                        "total": total_steps, 
-                        "message": "Executing merge step"
-                    }))
-                    
-                    merge_input = {
-                        **input_json,
-                        'previous_output': output_context.get('previous_output', ''),
-                        'branch_outputs': branch_outputs[f"branch_{step['branchStepIndex']}"]
-                    }
-                    try:
-                        output = await run_shortcut(step['shortcutName'], merge_input)
-                        output_context['previous_output'] = output
-                        result_queue.put(json.dumps({
-                            "status": "output", 
-                            "step": current_step, 
-                            "total": total_steps, 
-                            "output": output
-                        }))
-                    except Exception as e:
-                        result_queue.put(json.dumps({
-                            "status": "error", 
-                            "step": current_step, 
-                            "total": total_steps, 
-                            "message": f"Error in merge step: {str(e)}"
-                        }))
-                        raise
-                
-                else:
-                    current_step += 1
-                    result_queue.put(json.dumps({
-                        "status": "running", 
-                        "step": current_step, 
-                        "total": total_steps, 
-                        "message": f"Executing step: {step.get('name', 'Unnamed Step')}"
-                    }))
-                    
-                    # Combine input_json and output_context for merge tag replacement
-                    context = {**input_json, **output_context}
-                    
-                    # Replace merge tags in systemPrompt
-                    system_prompt = step.get('systemPrompt', '')
-                    system_prompt = replace_merge_tags(system_prompt, context)
-
-                    input_for_step = {
-                        **input_json,
-                        'user_input': output_context.get('previous_output', input_json.get('user_input', '')),
-                        'model': step.get('model', input_json.get('model', '')),
-                        'shortcut_name': step['shortcutName'],
-                        'system': system_prompt
-                    }
-
-                    try:
-                        output = await run_shortcut(step['shortcutName'], input_for_step)
-                        output_context['previous_output'] = output
-                        result_queue.put(json.dumps({
-                            "status": "output", 
-                            "step": current_step, 
-                            "total": total_steps, 
-                            "output": output
-                        }))
-                    except Exception as e:
-                        result_queue.put(json.dumps({
-                            "status": "error", 
-                            "step": current_step, 
-                            "total": total_steps, 
-                            "message": f"Error in step {step.get('name', 'Unnamed Step')}: {str(e)}"
-                        }))
-                        raise
-
-            result_queue.put(json.dumps({"status": "completed", "total": total_steps}))
-
-        asyncio.run(run_workflow_async())
+        start_run(trace, input_json)
+        logging.info(f"Starting run of workflow {workflow['name']}")
+        # The run id lets a client follow or cancel the run through any worker
+        events.put(json.dumps({"status": "started", "run_id": trace.run_id}))
+        asyncio.run(run_cancellable(run_workflow(workflow, input_json, events, trace), trace.run_id))
+    except asyncio.CancelledError:
+        logging.info("Run cancelled")
+        event = json.dumps({"status": "error", "message": "Run cancelled", "run_id": trace.run_id})
+        finish_run(trace, 'cancelled', 'Run cancelled', event)
+        events.put(event)
     except Exception as e:
         logging.error(f"Error in workflow execution: {str(e)}")
-        result_queue.put(json.dumps({"status": "error", "message": str(e)}))
+        event = json.dumps({"status": "error", "message": str(e), "run_id": trace.run_id})
+        finish_run(trace, 'error', str(e), event)
+        events.put(event)
+    finally:
+        events.close()
 
 
 
@@ -1195,6 +3439,9 @@ HTML = """
                     console.log('Workflow completed');
                     progressBar.style.width = '100%';
                     statusText.textContent = 'Workflow completed successfully';
+                    if (data.run_id) {
+                        stepOutputs.insertAdjacentHTML('beforeend', `<a href="/run-trace/${data.run_id}" download="trace-${data.run_id}.json" class="text-blue-500 underline text-sm">Download execution trace</a>`);
+                    }
                     eventSource.close();
                 } else if (data.status === 'error') {
                     console.error('Workflow error:', data.message);
@@ -1443,12 +3690,12 @@ HTML = """
                 fetch('/shortcuts')
                     .then(response => response.json())
                     .then(data => {
-                        shortcuts = data;
+                        shortcuts = data.shortcuts;
                         const shortcutSelect = document.getElementById('shortcut-select');
                         const shortcutDropdown = document.getElementById('shortcut-dropdown');
                         shortcutSelect.innerHTML = '<option value="">Add step</option>';
                         shortcutDropdown.innerHTML = '<option value="">Select a shortcut</option>';
-                        data.forEach(shortcut => {
+                        data.shortcuts.forEach(shortcut => {
                             const option = document.createElement('option');
                             option.value = JSON.stringify(shortcut);
                             option.textContent = shortcut.name;
@@ -1502,7 +3749,7 @@ HTML = """
             .then(response => response.json())
             .then(data => {
                 alert(data.message);
-                loadShortcuts();
+                waitForShortcutRefresh();
             })
             .catch(error => {
                 console.error('Error:', error);
@@ -1510,6 +3757,23 @@ HTML = """
             });
         });
 
+        function waitForShortcutRefresh() {
+            // The refresh runs in the background; reload the list once it lands
+            fetch('/discovery-status')
+                .then(response => response.json())
+                .then(data => {
+                    if (data.shortcuts.refreshing) {
+                        setTimeout(waitForShortcutRefresh, 500);
+                    } else {
+                        if (data.shortcuts.error) {
+                            console.error('Error refreshing shortcuts:', data.shortcuts.error);
+                        }
+                        loadShortcuts();
+                    }
+                })
+                .catch(error => console.error('Error:', error));
+        }
+
         document.getElementById('run-shortcut').addEventListener('click', () => {
             const shortcutName = document.getElementById('shortcut-name').textContent;
             const inputText = document.getElementById('shortcut-input').value;
@@ -1876,17 +4140,24 @@ HTML = """
         }
 
         let ollamaModels = [];
-        fetch('/ollama-models')
-            .then(response => response.json())
-            .then(data => {
-                ollamaModels = data;
-                updateWorkflowDisplay();
-            })
-            .catch(error => {
-                console.error('Error fetching Ollama models:', error);
-                ollamaModels = ['Error fetching models'];
-                updateWorkflowDisplay();
-            });
+        function loadOllamaModels() {
+            fetch('/ollama-models')
+                .then(response => response.json())
+                .then(data => {
+                    ollamaModels = data.models;
+                    updateWorkflowDisplay();
+                    // A cold cache answers immediately; pick up the models once discovered
+                    if (data.refreshing && data.age === null) {
+                        setTimeout(loadOllamaModels, 1000);
+                    }
+                })
+                .catch(error => {
+                    console.error('Error fetching Ollama models:', error);
+                    ollamaModels = ['Error fetching models'];
+                    updateWorkflowDisplay();
+                });
+        }
+        loadOllamaModels();
 
 
         // Settings functionality
@@ -2025,12 +4296,179 @@ HTML = """
 """
 
 class OllamaHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the SPA's fetches on persistent connections; every response
+    # must therefore carry a Content-Length (or close the connection, as the
+    # event streams do). Headers and body go out in separate writes, so Nagle's
+    # algorithm would otherwise stall each keep-alive response on a delayed ACK.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+
+    def timed(self, handler):
+        start = time.perf_counter()
+        self.response_status = None
+        try:
+            handler()
+        finally:
+            http_request_duration.observe((self.command, metric_route(self.path), self.response_status or ''),
+                                          time.perf_counter() - start)
+
     def do_GET(self):
+        self.timed(self.handle_get)
+
+    def do_POST(self):
+        self.timed(self.handle_post)
+
+    def do_DELETE(self):
+        self.timed(self.handle_delete)
+
+    def send_body(self, body, content_type='application/json', status=200, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data, default=json_default).encode()
+        headers = {**(headers or {}), 'Vary': 'Accept-Encoding'}
+        if len(body) >= GZIP_MIN_SIZE and accepts_gzip(self.headers.get('Accept-Encoding', '')):
+            body, elapsed = gzip_body(body)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Server-Timing'] = f'gzip;dur={elapsed * 1000:.2f}'
+        self.send_body(body, 'application/json', status, headers)
+
+    def send_event_stream_headers(self):
+        # Event streams have no known length, so they end by closing the connection
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        # Access log lines go through the logging queue instead of straight to stderr
+        access_logger.info(format % args, extra={'client': self.client_address[0]})
+
+    def is_admin(self):
+        if ADMIN_TOKEN:
+            return self.headers.get('Authorization') == f"Bearer {ADMIN_TOKEN}"
+        return self.client_address[0] in ('127.0.0.1', '::1')
+
+    def is_agent(self):
+        if AGENT_TOKEN:
+            return self.headers.get('Authorization') == f"Bearer {AGENT_TOKEN}"
+        return self.client_address[0] in ('127.0.0.1', '::1')
+
+    def handle_agent_post(self, data):
+        # /agents/register, /agents/<id>/heartbeat, /agents/<id>/poll and /agents/<id>/jobs/<job_id>
+        if not self.is_agent():
+            self.send_json({"error": "Forbidden"}, 403)
+            return
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts == ['agents', 'register']:
+            try:
+                agent_id = register_agent(str(data.get('name') or self.client_address[0]),
+                                          [str(name) for name in data.get('shortcuts', [])],
+                                          [str(name) for name in data.get('models', [])],
+                                          max(int(data.get('slots', 1)), 1), float(data.get('load', 0)))
+            except (TypeError, ValueError):
+                self.send_json({"error": "Invalid agent registration"}, 400)
+                return
+            self.send_json({"agent_id": agent_id, "heartbeat_interval": AGENT_HEARTBEAT_INTERVAL,
+                            "poll_seconds": AGENT_POLL_SECONDS})
+            return
+        agent_id = parts[1] if len(parts) > 2 else None
+        if not agent_id or not touch_agent(agent_id, data.get('load')):
+            self.send_json({"error": "Unknown agent"}, 404)
+        elif parts[2:] == ['heartbeat']:
+            self.send_json({"cancel": cancelled_agent_jobs(agent_id)})
+        elif parts[2:] == ['poll']:
+            # Long poll; jobs queued by this process wake it at once, others within
+            # 0.1s. The agent is marked seen every second while it waits.
+            deadline = time.time() + AGENT_POLL_SECONDS
+            touched = time.time()
+            job = claim_agent_job(agent_id)
+            while not job and time.time() < deadline:
+                with agent_jobs_available:
+                    agent_jobs_available.wait(0.1)
+                if time.time() - touched >= 1:
+                    if not touch_agent(agent_id):
+                        self.send_json({"error": "Unknown agent"}, 404)
+                        return
+                    touched = time.time()
+                job = claim_agent_job(agent_id)
+            if job:
+                self.send_json(job)
+            else:
+                self.send_body(b'', None, 204)
+        elif len(parts) == 4 and parts[2] == 'jobs':
+            complete_agent_job(agent_id, parts[3], data.get('output'), data.get('error'))
+            self.send_json({"message": "Result recorded"})
+        else:
+            # Not 404, which tells the agent to register again
+            self.send_json({"error": "Unknown agent request"}, 400)
+
+    def stream_run_events(self, run_id, query):
+        # Tails a run's events from SQLite, so it works whichever worker runs it
+        try:
+            last_id = int(query.get('after', ['0'])[0])
+        except ValueError:
+            last_id = 0
+        events, run = get_run_events(run_id, last_id)
+        if run is None:
+            self.send_json({"error": "Run not found"}, 404)
+            return
+        self.send_event_stream_headers()
+        while True:
+            for event_id, data in events:
+                self.wfile.write(f"id: {event_id}\ndata: {data}\n\n".encode())
+                last_id = event_id
+            if any(json.loads(data)['status'] in TERMINAL_RUN_STATUSES for _, data in events):
+                break
+            if run[0] != 'running' and not events:
+                # The final event was stored after the events were read, or
+                # the run ended without one (its worker died)
+                self.wfile.write(f"data: {final_run_event(run_id, run)}\n\n".encode())
+                break
+            self.wfile.flush()
+            time.sleep(RUN_EVENT_POLL_INTERVAL)
+            events, run = get_run_events(run_id, last_id)
+        self.wfile.flush()
+
+    def send_run_rejected(self):
+        retry_after = run_admission.retry_after()
+        self.send_json({"error": "Too many workflow runs in progress", "retry_after": retry_after,
+                        "runs": run_admission.status()}, 429, headers={'Retry-After': str(retry_after)})
+
+    def etag_headers(self, etag):
+        return {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    def send_not_modified(self, etag):
+        # Answer 304 when the client already holds the current version of a listing
+        if_none_match = self.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if '*' not in tags and etag not in tags:
+            return False
+        self.send_body(b'', None, 304, self.etag_headers(etag))
+        return True
+
+    def handle_get(self):
         if self.path == '/api/workflows':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            workflows = get_workflows()
+            etag = get_table_etag('workflows')
+            if self.send_not_modified(etag):
+                return
+            workflows = get_workflows(with_steps=False)
             simplified_workflows = [
                 {
                     'id': w['id'],
@@ -2039,64 +4477,78 @@ class OllamaHandler(BaseHTTPRequestHandler):
                 }
                 for w in workflows
             ]
-            self.wfile.write(json.dumps(simplified_workflows).encode())
+            self.send_json(simplified_workflows, headers=self.etag_headers(etag))
             return
 
         elif self.path == '/workflows':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(get_workflows()).encode())
+            etag = get_table_etag('workflows')
+            if self.send_not_modified(etag):
+                return
+            self.send_json(get_workflows(), headers=self.etag_headers(etag))
 
         elif self.path.startswith('/get-workflow/'):
             workflow_id = self.path.split('/')[-1]
-            workflow = next((w for w in get_workflows() if w['id'] == workflow_id), None)
+            workflow = get_workflow(workflow_id)
             if workflow:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(workflow).encode())
+                self.send_json(workflow)
             else:
-                self.send_response(404)
-                self.end_headers()
+                self.send_body(b'', None, 404)
+
+        elif self.path.startswith('/export-workflow/'):
+            workflow_id = self.path.split('/')[-1]
+            exported = export_workflow(workflow_id)
+            if exported:
+                self.send_json(exported, headers={'Content-Disposition': f'attachment; filename="{workflow_id}.json"'})
+            else:
+                self.send_body(b'', None, 404)
+
+        elif self.path.startswith('/steps?'):
+            query = parse_qs(urlparse(self.path).query)
+            model = query.get('model', [None])[0]
+            shortcut_name = query.get('shortcut', [None])[0]
+            if not model and not shortcut_name:
+                self.send_json({"error": "model or shortcut is required"}, 400)
+                return
+            self.send_json(find_workflow_steps(model, shortcut_name))
 
         elif self.path == '/shortcuts':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(get_shortcuts()).encode())
+            # The cache reports (and when stale, starts) the refresh; the list
+            # itself is read from the table, which holds edited descriptions
+            discovery = shortcut_discovery.snapshot()
+            etag = f'{get_table_etag("shortcuts")[:-1]}-{shortcut_discovery.version}"'
+            if self.send_not_modified(etag):
+                return
+            self.send_json({**discovery, 'shortcuts': get_shortcuts()}, headers=self.etag_headers(etag))
 
         elif self.path == '/knowledge-structures':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(get_knowledge_structures()).encode())
+            etag = get_table_etag('knowledge_structures')
+            if self.send_not_modified(etag):
+                return
+            self.send_json(get_knowledge_structures(), headers=self.etag_headers(etag))
 
         elif self.path.startswith('/run-workflow/'):
-            self.send_response(200)
-            self.send_header('Content-type', 'text/event-stream')
-            self.send_header('Cache-Control', 'no-cache')
-            self.send_header('Connection', 'keep-alive')
-            self.end_headers()
-
             workflow_id = self.path.split('/')[2].split('?')[0]
             query = parse_qs(self.path.split('?')[1])
             input_json = json.loads(unquote_plus(query['input'][0]))
-            workflow = next((w for w in get_workflows() if w['id'] == workflow_id), None)
+            workflow = get_workflow(workflow_id)
             if workflow:
                 status_queue = Queue()
-                threading.Thread(target=workflow_runner, args=(workflow, input_json, status_queue)).start()
-                
+                if not start_workflow_run(workflow, input_json, status_queue):
+                    self.send_run_rejected()
+                    return
+                self.send_event_stream_headers()
+
                 while True:
                     try:
                         status = status_queue.get(timeout=1)
                         self.wfile.write(f"data: {status}\n\n".encode())
                         self.wfile.flush()
-                        if json.loads(status)['status'] == 'completed':
+                        if json.loads(status)['status'] in ('completed', 'error'):
                             break
-                    except:
+                    except queue.Empty:
                         continue
             else:
+                self.send_event_stream_headers()
                 self.wfile.write(b"data: {\"error\": \"Workflow not found\"}\n\n")
                 self.wfile.flush()
 
@@ -2106,44 +4558,116 @@ class OllamaHandler(BaseHTTPRequestHandler):
             input_json = json.loads(unquote_plus(query['input'][0]))
             try:
                 result = asyncio.run(run_shortcut(shortcut_name, input_json))
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"result": result}).encode())
+                self.send_json({"result": result})
             except Exception as e:
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
+                self.send_json({"error": str(e)}, 500)
+
+        elif urlparse(self.path).path == '/search':
+            query = parse_qs(urlparse(self.path).query)
+            if not query.get('q', [''])[0].strip():
+                self.send_json({"error": "q is required"}, 400)
+                return
+            try:
+                page = max(int(query.get('page', ['1'])[0]), 1)
+                limit = min(max(int(query.get('limit', ['20'])[0]), 1), 100)
+            except ValueError:
+                self.send_json({"error": "page and limit must be integers"}, 400)
+                return
+            if not search_enabled:
+                self.send_json({"error": "Full-text search is unavailable"}, 503)
+                return
+            try:
+                self.send_json(full_text_search(query.get('q', [''])[0], query.get('kind', [None])[0], page, limit))
+            except sqlite3.OperationalError as e:
+                logging.error(f"Error searching: {str(e)}")
+                self.send_json({"error": "Invalid search query"}, 400)
 
         elif self.path == '/ollama-models':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            models = get_ollama_models()
-            self.wfile.write(json.dumps(models).encode())
+            self.send_json(ollama_model_discovery.snapshot())
+
+        elif self.path == '/runs' or self.path.startswith('/runs?'):
+            query = parse_qs(urlparse(self.path).query)
+            try:
+                limit = min(max(int(query.get('limit', ['50'])[0]), 1), 500)
+                self.send_json(list_runs(query.get('workflow_id', [None])[0], query.get('status', [None])[0],
+                                         limit, query.get('before', [None])[0]))
+            except ValueError:
+                self.send_json({"error": "Invalid limit or cursor"}, 400)
+
+        elif self.path.startswith('/runs/') and urlparse(self.path).path.endswith('/events'):
+            self.stream_run_events(self.path.split('/')[2], parse_qs(urlparse(self.path).query))
+
+        elif self.path.startswith('/runs/'):
+            run = get_run_history(self.path.split('/')[-1])
+            if run:
+                self.send_json(run)
+            else:
+                self.send_json({"error": "Run not found"}, 404)
+
+        elif self.path.startswith('/run-trace/'):
+            run = get_run(self.path.split('/')[-1])
+            if run:
+                self.send_json(chrome_trace(run))
+            else:
+                self.send_json({"error": "Run not found"}, 404)
+
+        elif self.path.startswith('/admin/profile'):
+            if not self.is_admin():
+                self.send_json({"error": "Forbidden"}, 403)
+                return
+            query = parse_qs(urlparse(self.path).query)
+            try:
+                seconds = float(query.get('seconds', ['10'])[0])
+                interval = float(query.get('interval_ms', ['10'])[0]) / 1000
+            except ValueError:
+                self.send_json({"error": "seconds and interval_ms must be numbers"}, 400)
+                return
+            if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0.001 <= interval <= 1:
+                self.send_json({"error": f"seconds must be in (0, {PROFILE_MAX_SECONDS}] and interval_ms in [1, 1000]"}, 400)
+                return
+            if not profile_lock.acquire(blocking=False):
+                self.send_json({"error": "A profile is already running"}, 409)
+                return
+            try:
+                logging.info(f"Profiling all threads for {seconds}s every {interval * 1000:.0f}ms")
+                counts, samples = profile_stacks(seconds, interval)
+            finally:
+                profile_lock.release()
+            self.send_body(collapsed_stacks(counts).encode(), 'text/plain; charset=utf-8',
+                           headers={'X-Profile-Samples': str(samples)})
+
+        elif self.path == '/agents':
+            self.send_json(list_agents())
+
+        elif self.path == '/scheduler':
+            self.send_json({**shortcut_scheduler.status(), 'runs': run_admission.status()})
+
+        elif self.path == '/metrics':
+            self.send_body(render_metrics(collect_metrics()).encode(), 'text/plain; version=0.0.4; charset=utf-8')
+
+        elif self.path == '/discovery-status':
+            self.send_json({
+                'models': ollama_model_discovery.status(),
+                'shortcuts': shortcut_discovery.status()
+            })
 
         elif self.path == '/user-prompts':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(get_user_prompts()).encode())
+            etag = get_table_etag('user_prompts')
+            if self.send_not_modified(etag):
+                return
+            self.send_json(get_user_prompts(), headers=self.etag_headers(etag))
 
         elif self.path.startswith('/user-prompt/'):
             prompt_id = self.path.split('/')[-1]
             prompt = get_user_prompt(prompt_id)
             if prompt:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(prompt).encode())
+                self.send_json(prompt)
             else:
-                self.send_response(404)
-                self.end_headers()
+                self.send_body(b'', None, 404)
 
         elif self.path.startswith('/api/workflow-details/'):
             workflow_id = self.path.split('/')[-1]
-            workflow = next((w for w in get_workflows() if w['id'] == workflow_id), None)
+            workflow = get_workflow(workflow_id)
             if workflow:
                 workflow_details = {
                     'id': workflow['id'],
@@ -2151,31 +4675,19 @@ class OllamaHandler(BaseHTTPRequestHandler):
                     'description': workflow.get('description', 'No description available'),
                     'form_definition': workflow.get('form_definition', [])
                 }
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(workflow_details).encode())
+                self.send_json(workflow_details)
             else:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Workflow not found"}).encode())
+                self.send_json({"error": "Workflow not found"}, 404)
 
         else:
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(HTML.encode())
+            self.send_body(HTML.encode(), 'text/html')
 
-    def do_POST(self):
+    def handle_post(self):
         content_length = int(self.headers.get('Content-Length', 0))
         post_data = self.rfile.read(content_length)
         
-        logging.debug(f"Received POST request to {self.path}")
-        logging.debug(f"POST data: {post_data}")
-
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"POST {self.path} ({len(post_data)} bytes): {payload_preview(post_data)}")
 
         try:
             data = json.loads(post_data.decode('utf-8'))
@@ -2189,12 +4701,15 @@ class OllamaHandler(BaseHTTPRequestHandler):
                 if not workflow_id:
                     raise ValueError("Workflow ID is required")
                 
-                workflow = next((w for w in get_workflows() if w['id'] == workflow_id), None)
+                workflow = get_workflow(workflow_id)
                 if not workflow:
                     raise ValueError(f"Workflow with ID {workflow_id} not found")
 
                 result_queue = Queue()
-                threading.Thread(target=workflow_runner, args=(workflow, input_data, result_queue)).start()
+                client = self.headers.get('X-Client-Id') or self.client_address[0]
+                if not start_workflow_run(workflow, input_data, result_queue, BATCH, client):
+                    self.send_run_rejected()
+                    return
                 
                 final_result = None
                 while True:
@@ -2204,21 +4719,20 @@ class OllamaHandler(BaseHTTPRequestHandler):
                         if result_data.get('status') == 'completed':
                             final_result = result_data
                             break
+                        if result_data.get('status') == 'error':
+                            raise ValueError(result_data.get('message', 'Workflow execution failed'))
                     except queue.Empty:
                         continue
                 
                 if final_result:
-                    self.wfile.write(json.dumps(final_result).encode())
+                    self.send_json(final_result)
                 else:
                     raise ValueError("Workflow execution did not complete successfully")
             except Exception as e:
                 logging.error(f"Error running workflow via API: {str(e)}")
-                self.wfile.write(json.dumps({"status": "error", "message": str(e)}).encode())
+                self.send_json({"status": "error", "message": str(e)})
                 
-        if self.path == '/save-workflow':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
+        elif self.path == '/save-workflow':
             try:
                 workflow_id = data.get('id')
                 if not workflow_id:
@@ -2226,8 +4740,7 @@ class OllamaHandler(BaseHTTPRequestHandler):
                     data['id'] = workflow_id
 
                 # Update existing workflow or create a new one
-                existing_workflows = get_workflows()
-                workflow = next((w for w in existing_workflows if w['id'] == workflow_id), None)
+                workflow = get_workflow(workflow_id)
                 if workflow:
                     workflow.update(data)
                 else:
@@ -2235,14 +4748,16 @@ class OllamaHandler(BaseHTTPRequestHandler):
 
                 save_workflow(workflow)
 
-                self.wfile.write(json.dumps({"message": "Workflow saved successfully", "id": workflow_id}).encode())
+                self.send_json({"message": "Workflow saved successfully", "id": workflow_id})
+            except ValueError as e:
+                self.send_json({"error": f"Failed to save workflow: {str(e)}"}, 400)
             except Exception as e:
                 logging.error(f"Error saving workflow: {str(e)}")
-                self.wfile.write(json.dumps({"error": f"Failed to save workflow: {str(e)}"}).encode())
+                self.send_json({"error": f"Failed to save workflow: {str(e)}"})
         elif self.path.startswith('/save-form/'):
             workflow_id = self.path.split('/')[-1]
             try:
-                workflow = next((w for w in get_workflows() if w['id'] == workflow_id), None)
+                workflow = get_workflow(workflow_id)
                 if workflow:
                     for field in data:
                         if field['type'] in ['select', 'dropdown']:
@@ -2250,121 +4765,355 @@ class OllamaHandler(BaseHTTPRequestHandler):
                             field['default'] = field.get('default', '')
                     workflow['form_definition'] = data
                     save_workflow(workflow)
-                    self.wfile.write(json.dumps({"message": "Form saved successfully"}).encode())
+                    self.send_json({"message": "Form saved successfully"})
                 else:
-                    self.wfile.write(json.dumps({"error": "Workflow not found"}).encode())
+                    self.send_json({"error": "Workflow not found"})
             except Exception as e:
                 logging.error(f"Error saving form: {str(e)}")
-                self.wfile.write(json.dumps({"error": "Failed to save form"}).encode())
+                self.send_json({"error": "Failed to save form"})
         elif self.path == '/refresh-shortcuts':
             try:
-                refreshed_shortcuts = refresh_shortcuts()
-                self.wfile.write(json.dumps({"message": f"Shortcuts refreshed successfully. Found {len(refreshed_shortcuts)} shortcuts."}).encode())
+                shortcut_discovery.refresh_async()
+                status = shortcut_discovery.status()
+                self.send_json({
+                    "message": f"Shortcut refresh started. {status['count']} shortcuts currently cached.",
+                    **status
+                })
             except Exception as e:
                 logging.error(f"Error refreshing shortcuts: {str(e)}")
-                self.wfile.write(json.dumps({"error": "Failed to refresh shortcuts"}).encode())
+                self.send_json({"error": "Failed to refresh shortcuts"})
+        elif self.path.startswith('/update-step/'):
+            parts = self.path.split('/')
+            if len(parts) != 4:
+                self.send_json({"error": "Invalid endpoint"}, 404)
+                return
+            try:
+                step = update_workflow_step(unquote_plus(parts[2]), unquote_plus(parts[3]), data)
+                if step is None:
+                    self.send_json({"error": "Step not found"}, 404)
+                else:
+                    self.send_json({"message": "Step updated successfully", "step": step})
+            except ValueError as e:
+                self.send_json({"error": str(e)}, 400)
+            except Exception as e:
+                logging.error(f"Error updating step: {str(e)}")
+                self.send_json({"error": "Failed to update step"}, 500)
+        elif self.path.startswith('/agents/'):
+            self.handle_agent_post(data)
+        elif self.path.startswith('/runs/') and self.path.endswith('/cancel'):
+            if request_run_cancel(self.path.split('/')[2]):
+                self.send_json({"message": "Cancellation requested"})
+            else:
+                self.send_json({"error": "Run not found or not running"}, 404)
         elif self.path == '/update-shortcut-description':
             try:
                 update_shortcut_description(data['name'], data['description'])
-                self.wfile.write(json.dumps({"message": "Shortcut description updated successfully"}).encode())
+                self.send_json({"message": "Shortcut description updated successfully"})
             except Exception as e:
                 logging.error(f"Error updating shortcut description: {str(e)}")
-                self.wfile.write(json.dumps({"error": "Failed to update shortcut description"}).encode())
+                self.send_json({"error": "Failed to update shortcut description"})
         elif self.path == '/add-knowledge-structure':
             try:
                 save_knowledge_structure(data)
-                self.wfile.write(json.dumps({"message": "Knowledge structure added successfully"}).encode())
+                self.send_json({"message": "Knowledge structure added successfully"})
             except Exception as e:
                 logging.error(f"Error adding knowledge structure: {str(e)}")
-                self.wfile.write(json.dumps({"error": "Failed to add knowledge structure"}).encode())
+                self.send_json({"error": "Failed to add knowledge structure"})
         elif self.path == '/save-settings':
             try:
                 # Here you would implement logic to save settings
                 # For this example, we'll just log the received settings
                 logging.info(f"Received settings: {data}")
-                self.wfile.write(json.dumps({"message": "Settings saved successfully"}).encode())
+                self.send_json({"message": "Settings saved successfully"})
             except Exception as e:
                 logging.error(f"Error saving settings: {str(e)}")
-                self.wfile.write(json.dumps({"error": "Failed to save settings"}).encode())
+                self.send_json({"error": "Failed to save settings"})
         elif self.path == '/save-user-prompt':
             try:
                 save_user_prompt(data)
-                self.wfile.write(json.dumps({"message": "User prompt saved successfully"}).encode())
+                self.send_json({"message": "User prompt saved successfully"})
             except Exception as e:
                 logging.error(f"Error saving user prompt: {str(e)}")
-                self.wfile.write(json.dumps({"error": "Failed to save user prompt"}).encode())
+                self.send_json({"error": "Failed to save user prompt"})
         elif self.path == '/import-workflow':
             try:
                 imported_workflow = parse_imported_workflow(data)
                 save_workflow(imported_workflow)
-                self.wfile.write(json.dumps({"message": "Workflow imported successfully"}).encode())
+                self.send_json({"message": "Workflow imported successfully"})
             except Exception as e:
                 logging.error(f"Error importing workflow: {str(e)}")
-                self.wfile.write(json.dumps({"error": str(e)}).encode())
+                self.send_json({"error": str(e)})
         else:
-            self.wfile.write(json.dumps({'error': 'Invalid endpoint'}).encode())
+            self.send_json({'error': 'Invalid endpoint'})
 
-    def do_DELETE(self):
+    def handle_delete(self):
         if self.path.startswith('/delete-knowledge-structure/'):
             structure_id = self.path.split('/')[-1]
             try:
-                conn = sqlite3.connect('ollama_workflows.db')
-                c = conn.cursor()
-                c.execute("DELETE FROM knowledge_structures WHERE id = ?", (structure_id,))
-                conn.commit()
-                conn.close()
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"message": "Knowledge structure deleted successfully"}).encode())
+                delete_knowledge_structure(structure_id)
+                self.send_json({"message": "Knowledge structure deleted successfully"})
             except Exception as e:
                 logging.error(f"Error deleting knowledge structure: {str(e)}")
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to delete knowledge structure"}).encode())
+                self.send_json({"error": "Failed to delete knowledge structure"}, 500)
         elif self.path.startswith('/delete-user-prompt/'):
             prompt_id = self.path.split('/')[-1]
             try:
                 delete_user_prompt(prompt_id)
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"message": "User prompt deleted successfully"}).encode())
+                self.send_json({"message": "User prompt deleted successfully"})
             except Exception as e:
                 logging.error(f"Error deleting user prompt: {str(e)}")
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to delete user prompt"}).encode())
+                self.send_json({"error": "Failed to delete user prompt"}, 500)
         elif self.path.startswith('/delete-workflow/'):
             workflow_id = self.path.split('/')[-1]
             try:
                 delete_workflow(workflow_id)
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"message": "Workflow deleted successfully"}).encode())
+                self.send_json({"message": "Workflow deleted successfully"})
             except Exception as e:
                 logging.error(f"Error deleting workflow: {str(e)}")
-                self.send_response(500)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to delete workflow"}).encode())
+                self.send_json({"error": "Failed to delete workflow"}, 500)
         else:
-            self.send_response(404)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'error': 'Invalid endpoint'}).encode())
+            self.send_json({'error': 'Invalid endpoint'}, 404)
+
+# Multi-process serving: with OSUI_WORKERS above 1 the server binds one socket
+# and forks that many worker processes to accept on it. Workers share state
+# through SQLite (runs, run events, table versions) and publish their metrics
+# there every METRICS_PUBLISH_INTERVAL seconds for /metrics to merge. Scheduler
+# and admission limits apply per worker. The parent only restarts workers that
+# exit; worker 0 also runs the background jobs.
+METRICS_PUBLISH_INTERVAL = 5
+
+def publish_metrics():
+    conn = sqlite3.connect('ollama_workflows.db')
+    conn.execute("INSERT OR REPLACE INTO worker_metrics (worker, updated_at, data) VALUES (?, ?, ?)",
+                 (os.getpid(), time.time(), json.dumps(metrics_snapshot())))
+    conn.commit()
+    conn.close()
+
+def forget_worker_metrics(pid=None):
+    # Drops an exited worker's row, or every row when the server starts
+    conn = sqlite3.connect('ollama_workflows.db')
+    if pid is None:
+        conn.execute("DELETE FROM worker_metrics")
+    else:
+        conn.execute("DELETE FROM worker_metrics WHERE worker = ?", (pid,))
+    conn.commit()
+    conn.close()
+
+def collect_metrics():
+    if WORKERS <= 1:
+        return metrics_snapshot()
+    publish_metrics()
+    conn = sqlite3.connect('ollama_workflows.db')
+    rows = conn.execute("SELECT data FROM worker_metrics").fetchall()
+    conn.close()
+    return merge_metrics(json.loads(row[0]) for row in rows)
+
+def metrics_publish_loop():
+    while True:
+        time.sleep(METRICS_PUBLISH_INTERVAL)
+        try:
+            publish_metrics()
+        except Exception as e:
+            logging.error(f"Error publishing metrics: {str(e)}")
+
+def start_background_jobs():
+    init_shortcuts()  # Initialize shortcuts on startup
+    start_run_compaction()
+
+def serve_prefork(httpd, workers):
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                if index == 0:
+                    start_background_jobs()
+                threading.Thread(target=metrics_publish_loop, name='metrics-publisher', daemon=True).start()
+                httpd.serve_forever()
+            finally:
+                os._exit(0)
+        children[pid] = index
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    forget_worker_metrics()
+    for index in range(workers):
+        spawn(index)
+    try:
+        while True:
+            pid, status = os.wait()
+            index = children.pop(pid)
+            logging.warning(f"Worker {index} (pid {pid}) exited with status {status}; restarting it")
+            mark_worker_runs_interrupted(pid)
+            forget_worker_metrics(pid)
+            spawn(index)
+    except (KeyboardInterrupt, SystemExit):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in list(children):
+            os.waitpid(pid, 0)
+            mark_worker_runs_interrupted(pid)
+            forget_worker_metrics(pid)
 
 def run_server(port=8000):
     server_address = ('', port)
-    httpd = HTTPServer(server_address, OllamaHandler)
+    # Persistent connections hold a thread each, so connections must not serialize
+    httpd = ThreadingHTTPServer(server_address, OllamaHandler)
+    interrupted = mark_worker_runs_interrupted()
+    if interrupted:
+        logging.warning(f"Marked {interrupted} runs left running by a previous server as interrupted")
     print(f'Server running on http://localhost:{port}')
-    httpd.serve_forever()
+    if WORKERS > 1:
+        print(f'Serving with {WORKERS} worker processes')
+        serve_prefork(httpd, WORKERS)
+    else:
+        start_background_jobs()
+        httpd.serve_forever()
+
+# Agent mode: runs shortcuts for a server on another machine. Each of the
+# OSUI_AGENT_SLOTS threads long-polls the server for a job, runs it with the
+# local Shortcuts CLI and posts the output back; a heartbeat thread reports the
+# host's load and kills jobs whose run was cancelled.
+AGENT_SERVER = os.environ.get('OSUI_AGENT_SERVER', 'http://localhost:8000').rstrip('/')
+AGENT_NAME = os.environ.get('OSUI_AGENT_NAME', socket.gethostname())
+AGENT_SLOTS = int(os.environ.get('OSUI_AGENT_SLOTS', MAX_CONCURRENT_SHORTCUTS))
+AGENT_RETRY_INTERVAL = 5
+
+def agent_request(path, data):
+    headers = {'Content-Type': 'application/json'}
+    if AGENT_TOKEN:
+        headers['Authorization'] = f"Bearer {AGENT_TOKEN}"
+    request = urllib.request.Request(f"{AGENT_SERVER}{path}", data=json.dumps(data).encode(), headers=headers)
+    with urllib.request.urlopen(request, timeout=AGENT_POLL_SECONDS + 30) as response:
+        body = response.read()
+        return json.loads(body) if body else None
+
+class WorkerAgent:
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = slots
+        self.agent_id = None
+        self.heartbeat_interval = AGENT_HEARTBEAT_INTERVAL
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def register(self, stale_id=None):
+        # Called again by any thread the server no longer recognizes; only the
+        # first of them registers
+        with self.lock:
+            if self.agent_id != stale_id:
+                return
+            while True:
+                try:
+                    shortcuts = sorted({shortcut['name'] for shortcut in get_user_shortcuts()})
+                    break
+                except Exception as e:
+                    logging.warning(f"Could not list shortcuts: {str(e)}")
+                    time.sleep(AGENT_RETRY_INTERVAL)
+            try:
+                models = get_ollama_models()
+            except Exception as e:
+                logging.warning(f"Could not list Ollama models: {str(e)}")
+                models = []
+            while True:
+                try:
+                    response = agent_request('/agents/register', {
+                        'name': self.name, 'shortcuts': shortcuts, 'models': models,
+                        'slots': self.slots, 'load': host_load()})
+                    break
+                except OSError as e:
+                    logging.warning(f"Could not register with {AGENT_SERVER}: {str(e)}")
+                    time.sleep(AGENT_RETRY_INTERVAL)
+            self.agent_id = response['agent_id']
+            self.heartbeat_interval = response['heartbeat_interval']
+            logging.info(f"Registered with {AGENT_SERVER} as {self.agent_id}: {len(shortcuts)} shortcuts, {len(models)} models")
+
+    def call(self, action, data):
+        agent_id = self.agent_id
+        try:
+            return agent_request(f"/agents/{agent_id}/{action}", data)
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                raise
+            self.register(agent_id)
+            return None
+
+    def heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                response = self.call('heartbeat', {'load': host_load()})
+            except OSError as e:
+                logging.warning(f"Heartbeat failed: {str(e)}")
+                continue
+            for job_id in (response or {}).get('cancel', []):
+                with self.lock:
+                    process = self.processes.get(job_id)
+                if process:
+                    logging.info(f"Killing cancelled job {job_id}")
+                    process.kill()
+
+    def poll_loop(self):
+        while True:
+            try:
+                job = self.call('poll', {})
+            except OSError as e:
+                logging.warning(f"Poll failed: {str(e)}")
+                time.sleep(AGENT_RETRY_INTERVAL)
+                continue
+            if job:
+                self.run_job(job)
+
+    def run_job(self, job):
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as temp_file:
+            temp_file.write(job['payload'])
+            temp_file_path = temp_file.name
+        started = time.perf_counter()
+        try:
+            process = subprocess.Popen([*SHORTCUTS_COMMAND, 'run', job['shortcut_name'], '--input-path', temp_file_path],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            with self.lock:
+                self.processes[job['id']] = process
+            stdout, stderr = process.communicate()
+            if process.returncode == 0:
+                result = {'output': stdout.decode(errors='replace')}
+            else:
+                result = {'error': stderr.decode(errors='replace') or f"exit status {process.returncode}"}
+        except Exception as e:
+            result = {'error': str(e)}
+        finally:
+            with self.lock:
+                self.processes.pop(job['id'], None)
+            os.unlink(temp_file_path)
+        logging.info(f"Job {job['id']}: ran {job['shortcut_name']} in {time.perf_counter() - started:.3f}s"
+                     + (f" with error: {result['error']}" if 'error' in result else ''))
+        # The server waits on this result, so keep trying while it is reachable
+        for attempt in range(3):
+            try:
+                self.call(f"jobs/{job['id']}", result)
+                break
+            except OSError as e:
+                logging.warning(f"Could not report job {job['id']}: {str(e)}")
+                time.sleep(AGENT_RETRY_INTERVAL)
+
+    def run(self):
+        self.register()
+        threading.Thread(target=self.heartbeat_loop, name='agent-heartbeat', daemon=True).start()
+        pollers = [threading.Thread(target=self.poll_loop, name=f'agent-slot-{i}', daemon=True)
+                   for i in range(self.slots)]
+        for poller in pollers:
+            poller.start()
+        for poller in pollers:
+            poller.join()
 
 if __name__ == '__main__':
-    init_db()
-    init_shortcuts()  # Initialize shortcuts on startup
-    run_server()
-    
+    setup_logging()
+    if sys.argv[1:2] == ['agent']:
+        WorkerAgent(AGENT_NAME, AGENT_SLOTS).run()
+    else:
+        init_db()
+        run_server()